@@ -29,7 +29,9 @@ from gwpy.spectrogram import Spectrogram
 from gwpy.segments import DataQualityFlag
 
 from . import (globalv, mode, version)
-from .data import (get_channel, add_timeseries, add_spectrogram)
+from .data import (get_channel, add_timeseries, add_spectrogram,
+                   get_spectrogram_band)
+from .spectral import SpectrumSketch
 
 __author__ = 'Duncan Macleod <duncan.macleod@ligo.org>'
 __version__ = version.version
@@ -81,7 +83,8 @@ def write_data_archive(outfile, timeseries=True, spectrogram=True,
             if spectrogram:
                 group = h5file.create_group('spectrogram')
                 # loop over channels
-                for speclist in globalv.SPECTROGRAMS.itervalues():
+                for key, speclist in globalv.SPECTROGRAMS.iteritems():
+                    band = globalv.SPECTROGRAM_BANDS.get(key)
                     # loop over time-series
                     for spec in speclist:
                         name = '%s,%s' % (spec.name, spec.epoch.gps)
@@ -89,6 +92,16 @@ def write_data_archive(outfile, timeseries=True, spectrogram=True,
                             spec.write(group, name=name, format='hdf')
                         except ValueError:
                             continue
+                        # record the band, so that later jobs don't join
+                        # cropped and full-band data
+                        group[name].attrs['key'] = key
+                        group[name].attrs['frequency-band'] = (
+                            band is None and [] or band)
+                # record percentile sketches, to be merged by long-span jobs
+                if mode.get_mode() == mode.SUMMARY_MODE_DAY:
+                    group = h5file.create_group('spectrum-sketch')
+                    for key, sketch in globalv.SPECTRUM_SKETCHES.iteritems():
+                        sketch.write(group, key)
 
             # record all segment data
             if segments:
@@ -102,13 +115,19 @@ def write_data_archive(outfile, timeseries=True, spectrogram=True,
         raise
 
 
-def read_data_archive(sourcefile):
+def read_data_archive(sourcefile, skip_spectrograms=[], crop=False):
     """Read archived data from an HDF5 archive source.
 
     Parameters
     ----------
     sourcefile : `str`
         path to source HDF5 file
+    skip_spectrograms : `list` of `str`, optional
+        names of channels whose `Spectrogram` data should not be read
+    crop : `bool`, optional, default: `False`
+        whether this job crops spectrograms to the channel frequency
+        range, archived spectrograms cropped to a different band are
+        not read
     """
     from h5py import File
 
@@ -118,39 +137,76 @@ def read_data_archive(sourcefile):
             group = h5file['timeseries']
         except KeyError:
             group = dict()
+        keys = set()
         for dataset in group.itervalues():
             ts = TimeSeries.read(dataset, format='hdf')
             ts.channel = get_channel(ts.channel)
+            add_timeseries(ts, key=ts.channel.ndsname, coalesce=False)
+            keys.add(ts.channel.ndsname)
+        for key in keys:
             try:
-                add_timeseries(ts, key=ts.channel.ndsname)
+                globalv.DATA.coalesce(key)
             except ValueError:
                 if mode.get_mode() == mode.MODE_ENUM['day']:
                     raise
                 warnings.warn('Caught ValueError in combining daily archives')
-                # get end time
-                globalv.DATA[ts.channel.ndsname].pop(-1)
-                t = globalv.DATA[ts.channel.ndsname][-1].span[-1]
-                add_timeseries(ts.crop(start=t), key=ts.channel.ndsname)
+                _crop_overlaps(globalv.DATA[key])
+                globalv.DATA.invalidate(key)
+                globalv.DATA.coalesce(key)
 
         # read all state-vector data
         try:
             group = h5file['statevector']
         except KeyError:
             group = dict()
+        keys = set()
         for dataset in group.itervalues():
             sv = StateVector.read(dataset, format='hdf')
             sv.channel = get_channel(sv.channel)
-            add_timeseries(sv, key=sv.channel.ndsname)
+            add_timeseries(sv, key=sv.channel.ndsname, coalesce=False)
+            keys.add(sv.channel.ndsname)
+        globalv.DATA.coalesce(*keys)
 
         # read all spectrogram data
         try:
             group = h5file['spectrogram']
         except KeyError:
             group = dict()
-        for dataset in group.itervalues():
+        keys = set()
+        for dsname, dataset in group.iteritems():
+            if dsname.split(',', 1)[0] in skip_spectrograms:
+                continue
             spec = Spectrogram.read(dataset, format='hdf')
             spec.channel = get_channel(spec.channel)
-            add_spectrogram(spec)
+            key = dataset.attrs.get('key', spec.name or str(spec.channel))
+            band = get_spectrogram_band(spec.channel, crop=crop,
+                                        method=key.rsplit(',', 1)[-1])
+            try:
+                archived = tuple(dataset.attrs['frequency-band'])
+            except KeyError:  # unknown band, only use full-band data
+                archived = spec.f0.value and (None,) or ()
+            if archived and tuple(band or ()) != archived:
+                continue
+            elif band is not None and not archived:
+                spec = spec.crop_frequencies(*band)
+            globalv.SPECTROGRAM_BANDS[key] = band
+            add_spectrogram(spec, key=key, coalesce=False)
+            keys.add(key)
+        globalv.SPECTROGRAMS.coalesce(*keys)
+
+        # read all percentile sketches, merging with those already read
+        try:
+            group = h5file['spectrum-sketch']
+        except KeyError:
+            group = dict()
+        for key, dataset in group.iteritems():
+            sketch = SpectrumSketch.read(dataset)
+            try:
+                globalv.SPECTRUM_SKETCHES.setdefault(
+                    key, SpectrumSketch()).merge(sketch)
+            except ValueError as e:
+                warnings.warn('Cannot merge archived sketch for %s: %s'
+                              % (key, str(e)))
 
         try:
             group = h5file['segments']
@@ -161,6 +217,23 @@ def read_data_archive(sourcefile):
             globalv.SEGMENTS += {name: dqflag}
 
 
+def _crop_overlaps(serieslist):
+    """Crop each series in a list to start after the end of the previous
+
+    The list is sorted in place, and any series left empty are removed.
+    """
+    serieslist.sort(key=lambda ts: ts.span[0])
+    i = 1
+    while i < len(serieslist):
+        t = serieslist[i-1].span[1]
+        if serieslist[i].span[1] <= t:
+            serieslist.pop(i)
+            continue
+        elif serieslist[i].span[0] < t:
+            serieslist[i] = serieslist[i].crop(start=t)
+        i += 1
+
+
 def backup_existing_archive(filename, suffix='.hdf',
                             prefix='gw_summary_archive_', dir=None):
     """Create a copy of an existing archive.
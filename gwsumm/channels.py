@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Duncan Macleod (2013)
+#
+# This file is part of GWSumm.
+#
+# GWSumm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GWSumm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GWSumm.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Storage of channel metadata between and during jobs
+
+This module is imported by :mod:`gwsumm.globalv`, so must not import
+anything from GWSumm that itself requires the global memory.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import urllib2
+
+import numpy
+
+from gwpy.detector import (Channel, ChannelList)
+
+from . import version
+
+__author__ = 'Duncan Macleod <duncan.macleod@ligo.org>'
+__version__ = version.version
+
+
+class ChannelRegistry(ChannelList):
+    """A `ChannelList` indexed by channel name
+
+    The registry supports the standard `ChannelList` methods, but adds
+    :meth:`~ChannelRegistry.lookup`, which finds channels by name without
+    scanning the whole list.
+
+    Only the name is used as the index key, the ``type`` and
+    ``sample_rate`` are compared when looking up, so channels can be
+    modified in-place after being registered.
+    """
+    def __init__(self, *args, **kwargs):
+        super(ChannelRegistry, self).__init__(*args, **kwargs)
+        self._lock = threading.RLock()
+        self._index = {}
+        for channel in self:
+            self._index.setdefault(str(channel.name), []).append(channel)
+
+    def append(self, channel):
+        with self._lock:
+            super(ChannelRegistry, self).append(channel)
+            self._index.setdefault(str(channel.name), []).append(channel)
+
+    def extend(self, channels):
+        for channel in channels:
+            self.append(channel)
+
+    def insert(self, index, channel):
+        with self._lock:
+            super(ChannelRegistry, self).insert(index, channel)
+            self._index.setdefault(str(channel.name), []).append(channel)
+
+    def remove(self, channel):
+        with self._lock:
+            super(ChannelRegistry, self).remove(channel)
+            self._unindex(channel)
+
+    def pop(self, index=-1):
+        with self._lock:
+            channel = super(ChannelRegistry, self).pop(index)
+            self._unindex(channel)
+        return channel
+
+    def _unindex(self, channel):
+        bucket = self._index.get(str(channel.name), [])
+        for i, c in enumerate(bucket):
+            if c is channel:
+                bucket.pop(i)
+                break
+        if not bucket:
+            self._index.pop(str(channel.name), None)
+
+    def lookup(self, name, type=None, sample_rate=None):
+        """Find all registered channels matching the given parameters
+
+        Parameters
+        ----------
+        name : `str`
+            the exact name of the channel
+        type : `str`, optional
+            the NDS type of the channel, default: any type
+        sample_rate : `float`, `~astropy.units.Quantity`, optional
+            the sample rate of the channel, default: any rate
+
+        Returns
+        -------
+        channels : `list`
+            the `list` of matching channels
+        """
+        out = self._index.get(str(name), [])
+        if type is not None:
+            out = [c for c in out if c.type == type]
+        if sample_rate is not None:
+            sample_rate = float(getattr(sample_rate, 'value', sample_rate))
+            out = [c for c in out if c.sample_rate is not None and
+                   c.sample_rate.value == sample_rate]
+        return list(out)
+
+
+class ChannelCache(object):
+    """Persistent, on-disk store of channel metadata from the CIS
+
+    Each record is stored in an SQLite database along with the time at
+    which it was stored, records older than the ``ttl`` are considered
+    expired and will be re-queried from CIS.
+
+    Channels that CIS doesn't know about are also recorded, so that
+    non-CIS channels don't cost a network time-out on every job.
+
+    Parameters
+    ----------
+    path : `str`
+        path of SQLite database file, will be created if required
+    ttl : `float`, optional, default: one week
+        time-to-live (seconds) of each record
+
+    Attributes
+    ----------
+    hits : `int`
+        number of requests answered from the store
+    misses : `int`
+        number of requests that required a CIS query
+    """
+    ATTRIBUTES = ['sample_rate', 'unit', 'dtype', 'type', 'frametype',
+                  'model', 'url']
+
+    def __init__(self, path, ttl=604800):
+        self.path = path
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        dirname = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self._lock:
+            self._db.execute('CREATE TABLE IF NOT EXISTS channels '
+                             '(name TEXT PRIMARY KEY, metadata TEXT, '
+                             'stored REAL)')
+            self._db.commit()
+
+    def get(self, name):
+        """Return the stored metadata for the given channel name
+
+        Returns
+        -------
+        metadata : `dict`, `None`
+            `dict` of channel attributes, or `None` if this channel is
+            known not to exist in CIS
+
+        Raises
+        ------
+        KeyError
+            if no un-expired record exists for this channel
+        """
+        with self._lock:
+            row = self._db.execute(
+                'SELECT metadata, stored FROM channels WHERE name=?',
+                (name,)).fetchone()
+            if row is None or time.time() - row[1] > self.ttl:
+                self.misses += 1
+                raise KeyError(name)
+            self.hits += 1
+        return json.loads(row[0])
+
+    def valid(self, names):
+        """Return those of the given names that have un-expired records
+
+        This does not affect the ``hits`` or ``misses`` counters.
+        """
+        names = list(names)
+        out = []
+        with self._lock:
+            for i in range(0, len(names), 500):
+                batch = names[i:i+500]
+                rows = self._db.execute(
+                    'SELECT name FROM channels WHERE stored>? AND '
+                    'name IN (%s)' % ','.join('?' * len(batch)),
+                    [time.time() - self.ttl] + batch).fetchall()
+                out.extend(r[0] for r in rows)
+        return out
+
+    def put(self, name, metadata):
+        """Record the metadata for the given channel name
+        """
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO channels VALUES (?,?,?)',
+                             (name, json.dumps(metadata), time.time()))
+            self._db.commit()
+
+    def query(self, name, timeout=5):
+        """Find a `Channel` in the store, falling back to a CIS query
+
+        Parameters
+        ----------
+        name : `str`
+            name of channel to find
+        timeout : `float`, optional, default: 5
+            time-out (seconds) for the CIS query
+
+        Returns
+        -------
+        channel : `~gwpy.detector.Channel`
+            a new channel with the attributes recorded in CIS
+
+        Raises
+        ------
+        ValueError
+            if CIS doesn't know about this channel
+        """
+        try:
+            metadata = self.get(name)
+        except KeyError:
+            pass
+        else:
+            if metadata is None:
+                raise ValueError("No channels found matching '%s'." % name)
+            try:
+                return channel_from_metadata(name, metadata)
+            except (TypeError, ValueError):  # stale record, re-query
+                pass
+        try:
+            channel = Channel.query(name, timeout=timeout)
+        except ValueError:
+            self.put(name, None)
+            raise
+        self.put(name, channel_metadata(channel))
+        return channel
+
+    def warm(self, names, timeout=5):
+        """Query CIS for each name that doesn't have a valid record
+
+        Returns
+        -------
+        nfound : `int`
+            the number of names that CIS knows about
+        """
+        nfound = 0
+        for name in names:
+            try:
+                self.query(name, timeout=timeout)
+            except (ValueError, urllib2.URLError):
+                continue
+            nfound += 1
+        return nfound
+
+    def clear(self):
+        """Remove all records from the store
+        """
+        with self._lock:
+            self._db.execute('DELETE FROM channels')
+            self._db.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute(
+                'SELECT COUNT(*) FROM channels').fetchone()[0]
+
+    def __repr__(self):
+        return '<ChannelCache(%r, hits=%d, misses=%d)>' % (
+            self.path, self.hits, self.misses)
+
+
+def channel_metadata(channel):
+    """Format the attributes of a `Channel` as a JSON-compatible `dict`
+    """
+    out = {}
+    for attr in ChannelCache.ATTRIBUTES:
+        val = getattr(channel, attr, None)
+        if val is None:
+            continue
+        elif attr == 'sample_rate':
+            val = float(getattr(val, 'value', val))
+        elif attr == 'dtype':
+            val = numpy.dtype(val).name
+        else:
+            val = str(val)
+        out[attr] = val
+    return out
+
+
+def channel_from_metadata(name, metadata):
+    """Build a new `Channel` from the output of :func:`channel_metadata`
+    """
+    channel = Channel(name)
+    for attr, val in metadata.iteritems():
+        setattr(channel, attr, val)
+    return channel
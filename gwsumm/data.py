@@ -22,8 +22,10 @@
 import operator
 import os
 import urllib2
-from math import (floor, ceil, pi, sqrt)
+from math import (floor, ceil, log, pi, sqrt)
 from Queue import Queue
+from itertools import izip
+from multiprocessing.pool import ThreadPool
 import threading
 try:
     from configparser import (ConfigParser, NoSectionError, NoOptionError)
@@ -37,11 +39,10 @@ import operator
 
 from astropy import units
 
-from glue import datafind
 from glue.lal import Cache
 
 from gwpy.detector import Channel
-from gwpy.segments import (DataQualityFlag, SegmentList)
+from gwpy.segments import (DataQualityFlag, Segment, SegmentList)
 from gwpy.timeseries import (TimeSeries, TimeSeriesList, TimeSeriesDict,
                              StateVector, StateVectorDict)
 from gwpy.spectrum import Spectrum
@@ -49,6 +50,10 @@ from gwpy.spectrogram import SpectrogramList
 from gwpy.io import nds as ndsio
 
 from . import (globalv, version)
+from .expression import parse_expression
+from . import spectral
+from .nds import (iter_fetch, get_availability)
+from .frames import (datafind_connection, check_files_exist, read_ahead)
 from .mode import *
 from .utils import *
 
@@ -59,12 +64,18 @@ OPERATOR = {
     '/': operator.div,
 }
 
+# time decimation factor between spectrogram pyramid levels
+PYRAMID_FACTOR = 4
+
 __author__ = 'Duncan Macleod <duncan.macleod@ligo.org>'
 __version__ = version.version
 
 
 class ThreadChannelQuery(threading.Thread):
     """Threaded CIS `Channel` query.
+
+    Each thread works through ``(index, channel)`` items from the input
+    queue until it receives `None`.
     """
     def __init__(self, inqueue, outqueue):
         threading.Thread.__init__(self)
@@ -72,13 +83,18 @@ class ThreadChannelQuery(threading.Thread):
         self.out = outqueue
 
     def run(self):
-        i, channel = self.in_.get()
-        self.in_.task_done()
-        try:
-            self.out.put((i, get_channel(channel, False)))
-        except Exception as e:
-            self.out.put(e)
-        self.out.task_done()
+        while True:
+            item = self.in_.get()
+            if item is None:
+                self.in_.task_done()
+                break
+            i, channel = item
+            try:
+                self.out.put((i, get_channel(channel, False)))
+            except Exception as e:
+                self.out.put(e)
+            finally:
+                self.in_.task_done()
 
 
 def get_channel(channel, find_trend_source=True, timeout=5):
@@ -94,19 +110,16 @@ def get_channel(channel, find_trend_source=True, timeout=5):
     Channel : :class:`~gwpy.detector.channel.Channel`
         new channel.
     """
+    type_ = sr = None
     if ' ' in str(channel):
         name = str(channel)
-        found = globalv.CHANNELS.sieve(name=name.replace('*', '\*'),
-                                       exact_match=True)
     elif ',' in str(channel):
         name, type_ = str(channel).rsplit(',', 1)
-        found = globalv.CHANNELS.sieve(name=name, type=type_, exact_match=True)
     else:
         type_ = isinstance(channel, Channel) and channel.type or None
         sr = isinstance(channel, Channel) and channel.sample_rate or None
         name = str(channel)
-        found = globalv.CHANNELS.sieve(name=str(channel), type=type_,
-                                       sample_rate=sr, exact_match=True)
+    found = globalv.CHANNELS.lookup(name, type=type_, sample_rate=sr)
     if len(found) == 1:
         return found[0]
     elif len(found) > 1:
@@ -114,91 +127,139 @@ def get_channel(channel, find_trend_source=True, timeout=5):
                          "channels recovered:\n    %s"
                          % (str(channel),
                             '\n    '.join([c.ndsname for c in found])))
+    # trends are not stored in CIS, but try and get their raw source
+    if re_channel.match(name) and re.search('.[a-z]+\Z', name):
+        new = _new_trend_channel(name, type_, timeout=timeout,
+                                 find_trend_source=find_trend_source)
     else:
-        try:
-            if not re_channel.match(name):
-                raise ValueError()
-            # trends are not stored in CIS, but try and get their raw source
-            if re.search('.[a-z]+\Z', name):
-                raise TypeError()
-            new = Channel.query(name, timeout=timeout)
-        except TypeError:
-            # set default trend type based on mode
-            if type_ is None and globalv.MODE == SUMMARY_MODE_GPS:
-                type_ = 's-trend'
-            elif type_ is None:
-                type_ = 'm-trend'
-            name += ',%s' % type_
-            new = Channel(name)
-            if find_trend_source:
-                try:
-                    source = get_channel(name.rsplit('.', 1)[0])
-                except ValueError:
-                    pass
-                else:
-                    new.url = source.url
-                    new.unit = source.unit
-            # determine sample rate for trends
-            if type_ == 'm-trend':
-                new.sample_rate = 1/60.
-            elif type_ == 's-trend':
-                new.sample_rate = 1
-        except (ValueError, urllib2.URLError):
-            new = Channel(str(channel))
+        new = _new_channel(channel, name, timeout=timeout)
+    globalv.CHANNELS.append(new)
+    return new
+
+
+def _new_channel(channel, name, timeout=5):
+    """Query for a new raw `Channel`, falling back to an empty one
+    """
+    try:
+        if not re_channel.match(name):
+            raise ValueError()
+        if globalv.CHANNEL_CACHE is not None:
+            new = globalv.CHANNEL_CACHE.query(name, timeout=timeout)
         else:
-            new.name = str(channel)
-        globalv.CHANNELS.append(new)
-        try:
-            return get_channel(new)
-        except RuntimeError as e:
-            if 'maximum recursion depth' in str(e):
-                raise RuntimeError("Recursion error while access channel "
-                                   "information for %s" % str(channel))
-            else:
-                raise
+            new = Channel.query(name, timeout=timeout)
+    except (ValueError, urllib2.URLError):
+        return Channel(str(channel))
+    new.name = str(channel)
+    return new
 
 
-def get_channels(channels):
+def _new_trend_channel(name, type_, find_trend_source=True, timeout=5):
+    """Define a new trend `Channel`, inheriting metadata from its source
+    """
+    # set default trend type based on mode
+    if type_ is None and globalv.MODE == SUMMARY_MODE_GPS:
+        type_ = 's-trend'
+    elif type_ is None:
+        type_ = 'm-trend'
+    new = Channel('%s,%s' % (name, type_))
+    if find_trend_source:
+        sourcename = name.rsplit('.', 1)[0]
+        found = globalv.CHANNELS.lookup(sourcename)
+        if not found:
+            found = [_new_channel(sourcename, sourcename, timeout=timeout)]
+            globalv.CHANNELS.append(found[0])
+        if len(found) == 1:
+            new.url = found[0].url
+            new.unit = found[0].unit
+    # determine sample rate for trends
+    if type_ == 'm-trend':
+        new.sample_rate = 1/60.
+    elif type_ == 's-trend':
+        new.sample_rate = 1
+    return new
+
+
+def get_channels(channels, nthreads=8):
     """Multi-threaded channel query
+
+    Each unique channel is only queried once, and only those channels
+    that actually require a CIS query (i.e. that aren't trends, or
+    already recorded in the channel cache) are handed to the pool of
+    query threads.
+
+    Parameters
+    ----------
+    channels : `list` of `str`
+        list of channel names to define
+    nthreads : `int`, optional, default: 8
+        maximum number of concurrent CIS queries
+
+    Returns
+    -------
+    channellist : `list` of `~gwpy.detector.Channel`
+        the list of channels, in the same order as the input
     """
     if len(channels) == 0:
         return []
 
-    # set up Queues
-    inqueue = Queue()
-    outqueue = Queue()
-
-    # open threads
-    for i in range(len(channels)):
-        t = ThreadChannelQuery(inqueue, outqueue)
-        t.setDaemon(True)
-        t.start()
-
-    # populate input queue
-    for i, c in enumerate(channels):
-        inqueue.put((i, c))
-
-    # block
-    inqueue.join()
-    outqueue.join()
-    result = []
-    for i in range(len(channels)):
-        c = outqueue.get()
-        if isinstance(c, Exception):
-            raise c
-        else:
-            result.append(c)
-    return zip(*sorted(result, key=lambda (idx, chan): idx))[1]
+    # find unique names, and those that need a network query
+    names = []
+    unique = {}
+    for c in channels:
+        if str(c) not in unique:
+            names.append(str(c))
+            unique[str(c)] = c
+    cisnames = dict((_cis_name(n), n) for n in names if _cis_name(n))
+    if globalv.CHANNEL_CACHE is not None:
+        cached = set(globalv.CHANNEL_CACHE.valid(cisnames.keys()))
+    else:
+        cached = set()
+    remote = [n for (cis, n) in cisnames.iteritems() if cis not in cached]
+
+    # run remote queries through the thread pool
+    result = {}
+    if remote:
+        inqueue = Queue()
+        outqueue = Queue()
+        for i in range(min(nthreads, len(remote))):
+            t = ThreadChannelQuery(inqueue, outqueue)
+            t.setDaemon(True)
+            t.start()
+        for name in remote:
+            inqueue.put((name, unique[name]))
+        for i in range(min(nthreads, len(remote))):
+            inqueue.put(None)
+        inqueue.join()
+        while not outqueue.empty():
+            c = outqueue.get()
+            if isinstance(c, Exception):
+                raise c
+            result[c[0]] = c[1]
+
+    # and everything else in serial
+    for name in names:
+        if name not in result:
+            result[name] = get_channel(unique[name], False)
+    return [result[str(c)] for c in channels]
+
+
+def _cis_name(channel):
+    """Return the name required for a CIS query of this channel, if any
+    """
+    name = str(channel)
+    if ' ' not in name and ',' in name:
+        name = name.rsplit(',', 1)[0]
+    if not re_channel.match(name) or re.search('.[a-z]+\Z', name):
+        return None
+    return name
 
 
 def override_sample_rate(channel, rate):
-    try:
-        cid = globalv.CHANNELS.find(channel.name)
-    except ValueError:
-        print('Failed to reset sample_rate for %s' % channel.name)
-        pass
+    found = globalv.CHANNELS.lookup(channel.name)
+    if found:
+        found[0].sample_rate = rate
     else:
-        globalv.CHANNELS[cid].sample_rate = rate
+        print('Failed to reset sample_rate for %s' % channel.name)
 
 
 def find_frames(ifo, frametype, gpsstart, gpsend, config=ConfigParser(),
@@ -207,38 +268,6 @@ def find_frames(ifo, frametype, gpsstart, gpsend, config=ConfigParser(),
     """
     vprint('    Finding %s-%s frames for [%d, %d)...'
            % (ifo[0], frametype, int(gpsstart), int(gpsend)))
-    # find datafind host:port
-    try:
-        host = config.get('datafind', 'server')
-    except (NoOptionError, NoSectionError):
-        try:
-            host = os.environ['LIGO_DATAFIND_SERVER']
-        except KeyError:
-            host = None
-            port = None
-        else:
-            host, port = host.split(':')
-            port = int(port)
-    else:
-        port = config.getint('datafind', 'port')
-    # check certificates
-    if not port == 80:
-        cert, key = datafind.find_credential()
-    else:
-        cert, key = None, None
-    # connect with security
-    if cert and key:
-        dfconn = datafind.GWDataFindHTTPSConnection(host=host, port=port,
-                                                    cert_file=cert,
-                                                    key_file=key)
-    else:
-        dfconn = datafind.GWDataFindHTTPConnection(host=host, port=port)
-
-    # XXX HACK: LLO changed frame types on Dec 6 2013:
-    LLOCHANGE = 1070291904
-
-    if re.match('L1_{CRMT}', frametype) and gpsstart < LLOCHANGE:
-        frametype = frametype[-1]
 
     # query frames
     ifo = ifo[0].upper()
@@ -247,6 +276,68 @@ def find_frames(ifo, frametype, gpsstart, gpsend, config=ConfigParser(),
     if gpsend <= gpsstart:
         return Cache()
 
+    # use stored results where available, and only query the remainder
+    if globalv.FRAME_CACHE is not None:
+        cache, missing = globalv.FRAME_CACHE.get(ifo, frametype, gpsstart,
+                                                 gpsend, urltype=urltype)
+    else:
+        cache = Cache()
+        missing = SegmentList([Segment(gpsstart, gpsend)])
+    if len(missing):
+        cache.extend(_query_frames(ifo, frametype, missing, config=config,
+                                   urltype=urltype, gaps=gaps))
+    cache, missed = check_files_exist(_unique_cache(cache))
+
+    # stored files that have gone from disk must be found again
+    if globalv.FRAME_CACHE is not None and len(missed):
+        globalv.FRAME_CACHE.invalidate(ifo, frametype, missed,
+                                       urltype=urltype)
+        stale = (SegmentList(Segment(*e.segment) for e in missed).coalesce()
+                 & SegmentList([Segment(gpsstart, gpsend)])) - missing
+        if abs(stale):
+            found, _ = check_files_exist(_query_frames(
+                ifo, frametype, stale, config=config, urltype=urltype,
+                gaps=gaps))
+            cache = _unique_cache(cache + found)
+    vprint(' %d found.\n' % len(cache))
+    return cache
+
+
+def _query_frames(ifo, frametype, segments, config=ConfigParser(),
+                  urltype='file', gaps='warn'):
+    """Query the datafind server for frames in each of the given segments
+
+    Results are recorded in the `globalv.FRAME_CACHE`, if in use.
+    """
+    cache = Cache()
+    with datafind_connection(config) as dfconn:
+        for seg in segments:
+            new = _find_frame_urls(dfconn, ifo, frametype, int(seg[0]),
+                                   int(seg[1]), urltype=urltype, gaps=gaps)
+            if globalv.FRAME_CACHE is not None:
+                globalv.FRAME_CACHE.put(ifo, frametype, seg[0], seg[1],
+                                        new, urltype=urltype)
+            cache.extend(new)
+    return cache
+
+
+def _unique_cache(cache):
+    """Remove duplicate entries from a cache, and sort by start time
+    """
+    unique = dict((e.url, e) for e in cache)
+    return Cache(sorted(unique.values(), key=lambda e: e.segment[0]))
+
+
+def _find_frame_urls(dfconn, ifo, frametype, gpsstart, gpsend,
+                     urltype='file', gaps='warn'):
+    """Query the given datafind connection for frames
+    """
+    # XXX HACK: LLO changed frame types on Dec 6 2013:
+    LLOCHANGE = 1070291904
+
+    if re.match('L1_{CRMT}', frametype) and gpsstart < LLOCHANGE:
+        frametype = frametype[-1]
+
     try:
         cache = dfconn.find_frame_urls(ifo[0].upper(), frametype, gpsstart,
                                        gpsend, urltype=urltype, on_gaps=gaps)
@@ -266,8 +357,6 @@ def find_frames(ifo, frametype, gpsstart, gpsend, config=ConfigParser(),
                                                 'L1_%s' % frametype, start,
                                                 gpsend, urltype=urltype,
                                                 on_gaps=gaps)[1:])
-    cache, _ = cache.checkfilesexist()
-    vprint(' %d found.\n' % len(cache))
     return cache
 
 
@@ -289,21 +378,20 @@ def find_cache_segments(*caches):
     nframes = sum(len(c) for c in caches)
     if nframes == 0:
         return out
-    for cache in caches:
-        # build segment for this cache
-        if not len(cache):
-            continue
-        seg = cache[0].segment
-        for e in cache:
-            # if new segment doesn't overlap, append and start again
-            if e.segment.disjoint(seg):
-                out.append(seg)
-                seg = e.segment
-            # otherwise, append to current segment
-            else:
-                seg |= e.segment
-    # append final segment and return
-    out.append(seg)
+    # sort file segments by start time
+    starts = numpy.fromiter((e.segment[0] for c in caches for e in c),
+                            dtype=float, count=nframes)
+    ends = numpy.fromiter((e.segment[1] for c in caches for e in c),
+                          dtype=float, count=nframes)
+    order = starts.argsort(kind='mergesort')
+    starts = starts[order]
+    ends = numpy.maximum.accumulate(ends[order])
+    # a new segment starts wherever a file starts after all previous
+    # files have ended
+    breaks = (starts[1:] > ends[:-1]).nonzero()[0] + 1
+    segstarts = starts[numpy.concatenate(([0], breaks))]
+    segends = ends[numpy.concatenate((breaks - 1, [nframes - 1]))]
+    out.extend(Segment(a, b) for (a, b) in zip(segstarts, segends))
     return out
 
 
@@ -327,11 +415,98 @@ def find_frame_type(channel):
     return channel.frametype
 
 
-def find_types(site=None, match=None):
+def find_types(site=None, match=None, config=ConfigParser()):
     """Query the DataFind server for frame types matching the given options
     """
-    conn = datafind.GWDataFindHTTPConnection()
-    return conn.find_types(site=site, match=match)
+    with datafind_connection(config) as conn:
+        return conn.find_types(site=site, match=match)
+
+
+def _resolve_frametype(ifo, frametype, segments, config=ConfigParser()):
+    """Return the frametype to read for the given segments
+
+    Recent raw data are read from the ``<ifo>_C`` type, if available.
+    """
+    if (len(segments) and (globalv.NOW - segments[0][0]) < 86400 * 10 and
+            frametype == '%s_R' % ifo and
+            find_types(site=ifo[0], match='_C\Z', config=config)):
+        return '%s_C' % ifo
+    return frametype
+
+
+def _get_planned_frames(ifo, frametype, span):
+    """Return the frames found by :func:`plan_frames` for this span
+
+    Returns `None` if the given span wasn't covered by the plan.
+    """
+    try:
+        known, cache = globalv.FRAMES[(ifo, frametype)]
+    except KeyError:
+        return None
+    if span not in known:
+        return None
+    return cache.sieve(segment=span)
+
+
+def plan_frames(channels, segments, config=ConfigParser(), nds='guess',
+                nthreads=8):
+    """Find frames for all given channels in a single, parallel pass
+
+    Channels are grouped by (ifo, frametype), and each group is queried
+    once for the full extent of the given segments. The results are
+    recorded in `globalv.FRAMES`, and are used by all later calls to
+    :func:`get_timeseries_dict` covering the same span, instead of
+    querying the datafind server again.
+
+    Parameters
+    ----------
+    channels : `list`
+        list of channel names (or expressions) that will be read
+    segments : `~gwpy.segments.SegmentList`
+        list of segments for which data will be read
+    config : `~gwsumm.config.GWSummConfigParser`, optional
+        job configuration
+    nds : `bool`, `str`, optional, default: ``'guess'``
+        whether data will be read from NDS, in which case no frames
+        are required
+    nthreads : `int`, optional, default: 8
+        maximum number of concurrent datafind queries
+    """
+    if isinstance(segments, DataQualityFlag):
+        segments = segments.active
+    if nds == 'guess':
+        nds = 'LIGO_DATAFIND_SERVER' not in os.environ
+    if nds or not abs(segments):
+        return
+    span = segments.extent().protract(8)
+
+    # group channels by frametype
+    groups = set()
+    for name in set([c for group in
+                     map(lambda x: re_channel.findall(Channel(x).ndsname),
+                         channels) for c in group]):
+        channel = get_channel(name)
+        if channel.ifo is None:
+            continue
+        ftype = _resolve_frametype(channel.ifo, find_frame_type(channel),
+                                   segments, config=config)
+        if (channel.ifo, ftype) not in globalv.FRAMES:
+            groups.add((channel.ifo, ftype))
+    if not groups:
+        return
+
+    # query in parallel
+    def _find(group):
+        ifo, ftype = group
+        return group, find_frames(ifo, ftype, span[0], span[1],
+                                  config=config, gaps='ignore')
+    vprint("    Finding frames for %d frametypes...\n" % len(groups))
+    pool = ThreadPool(min(nthreads, len(groups)))
+    try:
+        for group, cache in pool.map(_find, sorted(groups)):
+            globalv.FRAMES[group] = (span, cache)
+    finally:
+        pool.close()
 
 
 def get_timeseries_dict(channels, segments, config=ConfigParser(),
@@ -343,9 +518,8 @@ def get_timeseries_dict(channels, segments, config=ConfigParser(),
     if query:
         frametypes = dict()
         allchannels = set([
-            c for group in
-                map(lambda x: re_channel.findall(Channel(x).ndsname), channels)
-            for c in group])
+            c for x in channels for
+            c in parse_expression(Channel(x).ndsname).channels])
         for channel in allchannels:
             channel = get_channel(channel)
             ifo = channel.ifo
@@ -355,66 +529,75 @@ def get_timeseries_dict(channels, segments, config=ConfigParser(),
                 frametypes[id_].append(channel)
             else:
                 frametypes[id_] = [channel]
-        for channellist in frametypes.itervalues():
+        # read each group in parallel, sharing the available processes
+        # and NDS connections
+        nthreads = min(len(frametypes), globalv.FETCH_THREADS)
+        ndsthreads = globalv.NDS_THREADS
+        if nthreads > 1:
+            if multiprocess is True:
+                nproc = count_free_cores()
+            elif multiprocess is False:
+                nproc = 1
+            else:
+                nproc = count_free_cores(multiprocess)
+            multiprocess = max(1, nproc // nthreads)
+            ndsthreads = max(1, ndsthreads // nthreads)
+
+        def _read(channellist):
             _get_timeseries_dict(channellist, segments, config=config,
                                  cache=cache, query=query, nds=nds,
                                  multiprocess=multiprocess,
+                                 ndsthreads=ndsthreads,
                                  statevector=statevector, return_=False,
                                  **ioargs)
+        if nthreads > 1:
+            pool = ThreadPool(nthreads)
+            try:
+                pool.map(_read, frametypes.values())
+            finally:
+                pool.close()
+        else:
+            map(_read, frametypes.values())
     if not return_:
         return
-    else:
-        out = dict()
-        for channel in channels:
-            channel = Channel(channel)
-            chanstrs = re_channel.findall(channel.ndsname)
-            chans = map(get_channel, chanstrs)
+    out = dict()
+    for channel in channels:
+        channel = Channel(channel)
+        expression = parse_expression(channel.ndsname)
+        chans = map(get_channel, expression.channels)
+        if expression.trivial:
             tsdict = _get_timeseries_dict(chans, segments, config=config,
                                           query=False, statevector=statevector,
                                           **ioargs)
+            out[channel.ndsname] = tsdict[chans[0].ndsname]
+            continue
+        # evaluate meta-channel for new times, and store the result
+        key = channel.ndsname
+        globalv.DERIVED.setdefault(key, TimeSeriesList())
+        new = segments - globalv.DERIVED.segments(key)
+        if abs(new):
+            tsdict = _get_timeseries_dict(chans, new, config=config,
+                                          query=False, statevector=statevector,
+                                          **ioargs)
             tslist = [tsdict[Channel(c).ndsname] for c in chans]
-            # if only one channel, simply append
-            if len(chanstrs) == 1 and len(channel.ndsname) == len(chanstrs[0]):
-                out[channel.ndsname] = tslist[0]
-            # if one channel and some operator, do calculation
-            elif len(chanstrs) == 1:
-                stub = channel.ndsname[len(chanstrs[0]):].strip(' ')
-                try:
-                   op = OPERATOR[stub[0]]
-                except KeyError as e:
-                   print(channel.ndsname, chanstrs, stub)
-                   e.args = ('Cannot parse math operator %r' % stub[0],)
-                   raise
-                value = float(stub[1:])
-                out[channel.ndsname] = type(tslist[0])(*[op(ts, value)
-                                                         for ts in tslist[0]])
-            # if multiple channels
-            else:
-                # build meta-timeseries
-                out[channel.ndsname] = TimeSeriesList()
-                operators = [channel.name[m.span()[1]] for m in
-                             list(re_channel.finditer(channel.ndsname))[:-1]]
-                for i in range(len(tslist[0])):
-                    out[channel.ndsname].append(tslist[0][i].copy())
-                    out[channel.ndsname][-1].name = str(channel)
-                    for op, ts in zip(operators, tslist[1:]):
-                        try:
-                            op = OPERATOR[op]
-                        except KeyError as e:
-                            e.args = ('Cannot parse math operator %r' % op,)
-                            raise
-                        out[channel.ndsname][-1] = op(out[channel.ndsname][-1],
-                                                      ts[i])
-        return out
+            for pieces in zip(*tslist):
+                globalv.DERIVED.append(key, expression(*pieces),
+                                       coalesce=False)
+            globalv.DERIVED.coalesce(key)
+            globalv.DERIVED.enforce_budget(key)
+        out[key] = _crop_stored(globalv.DERIVED, key, segments)
+    return out
 
 
 def _get_timeseries_dict(channels, segments, config=ConfigParser(),
                          cache=None, query=True, nds='guess',
                          multiprocess=True, return_=True, statevector=False,
-                         **ioargs):
+                         ndsthreads=None, **ioargs):
     """Internal method to retrieve the data for a set of like-typed
     channels using the :meth:`TimeSeriesDict.read` accessor.
     """
+    if ndsthreads is None:
+        ndsthreads = globalv.NDS_THREADS
     if isinstance(segments, DataQualityFlag):
         segments = segments.active
     channels = map(get_channel, channels)
@@ -430,10 +613,7 @@ def _get_timeseries_dict(channels, segments, config=ConfigParser(),
         DictClass = TimeSeriesDict
 
     # read segments from global memory
-    havesegs = reduce(operator.and_,
-                      (globalv.DATA.get(channel.ndsname,
-                                        ListClass()).segments
-                       for channel in channels))
+    havesegs = globalv.DATA.coverage(c.ndsname for c in channels)
     new = segments - havesegs
 
     # get processes
@@ -478,23 +658,14 @@ def _get_timeseries_dict(channels, segments, config=ConfigParser(),
     if cache is not None:
         query &= len(cache) > 0
     if query:
-        # open NDS connection
+        # find NDS server
         if nds and config.has_option('nds', 'host'):
-            host = config.get('nds', 'host')
-            port = config.getint('nds', 'port')
-            try:
-                ndsconnection = nds2.connection(host, port)
-            except RuntimeError as e:
-                if 'SASL authentication' in str(e):
-                    from gwpy.io.nds import kinit
-                    kinit()
-                    ndsconnection = nds2.connection(host, port)
-                else:
-                    raise
+            ndshost = config.get('nds', 'host')
+            ndsport = config.getint('nds', 'port')
             ftype = source = 'nds'
             ndstype = channels[0].type
         elif nds:
-            ndsconnection = None
+            ndshost = ndsport = None
             ftype = source = 'nds'
             ndstype = channels[0].type
         # or find frame type and check cache
@@ -505,10 +676,8 @@ def _get_timeseries_dict(channels, segments, config=ConfigParser(),
                 new = type(new)([s for s in new if abs(s) >= 60.])
             elif ftype is not None and ftype.endswith('%s_T' % ifo):
                 new = type(new)([s for s in new if abs(s) >= 1.])
-            elif ((globalv.NOW - new[0][0]) < 86400 * 10 and
-                  ftype == '%s_R' % ifo and
-                  find_types(site=ifo[0], match='_C\Z')):
-                ftype = '%s_C' % ifo
+            else:
+                ftype = _resolve_frametype(ifo, ftype, new, config=config)
             if cache is not None:
                 fcache = cache.sieve(ifos=ifo[0], description=ftype,
                                      exact_match=True)
@@ -516,8 +685,10 @@ def _get_timeseries_dict(channels, segments, config=ConfigParser(),
                 fcache = Cache()
             if (cache is None or len(fcache) == 0) and len(new):
                 span = new.extent().protract(8)
-                fcache = find_frames(ifo, ftype, span[0], span[1],
-                                     config=config, gaps='ignore')
+                fcache = _get_planned_frames(ifo, ftype, span)
+                if fcache is None:
+                    fcache = find_frames(ifo, ftype, span[0], span[1],
+                                         config=config, gaps='ignore')
             # parse discontiguous cache blocks and rebuild segment list
             cachesegments = find_cache_segments(fcache)
             new &= cachesegments
@@ -525,20 +696,29 @@ def _get_timeseries_dict(channels, segments, config=ConfigParser(),
         for channel in channels:
             channel.frametype = ftype
 
+        # only read whole samples (e.g. whole minutes for minute trends)
+        align = _sample_period(channels, ftype, minimum=0)
+        new = _align_segments(new, align)
+
         # check whether each channel exists for all new times already
         qchannels = []
         qresample = {}
         qdtype = {}
         for channel in channels:
-            oldsegs = globalv.DATA.get(channel.ndsname,
-                                       ListClass()).segments
-            if abs(new - oldsegs) != 0:
+            if abs(new - globalv.DATA.segments(channel.ndsname)) != 0:
                 qchannels.append(channel)
                 if channel in resample:
                     qresample[channel] = resample[channel]
                 qdtype[channel] = dtype_.get(channel, ioargs.get('dtype'))
         ioargs['dtype'] = qdtype
 
+        # only ask NDS for data it has
+        if nds:
+            available = get_availability(qchannels, new, host=ndshost,
+                                         port=ndsport)
+            if available is not None:
+                new = _align_segments(new & available, align)
+
         # find channel type
         if not nds:
             ctype = set()
@@ -553,59 +733,64 @@ def _get_timeseries_dict(channels, segments, config=ConfigParser(),
                 ctype = list(ctype)[0]
             else:
                 ctype = None
+        # only pad reads that are filtered or resampled
+        period = _sample_period(channels, ftype)
+        if any(c.ndsname in filter_ or c in resample for c in qchannels):
+            pad = ceil(globalv.READ_PAD / float(period)) * period
+        else:
+            pad = 0
+
         # loop through segments, recording data for each
         if len(new) and nproc > 1:
             vprint("    Fetching data (from %s) for %d channels [%s]"
                    % (source, len(qchannels), nds and ndstype or ftype))
-        for segment in new:
+        for i, segment in enumerate(new):
+            # pad resampling
+            cachepad = 0
+            if (not nds and segment[1] == cachesegments[-1][1] and
+                    qresample):
+                cachepad = ceil(8 / float(period)) * period
+                if abs(segment) <= cachepad:
+                    continue
+                segment = type(segment)(segment[0], segment[1] - cachepad)
+            # read data in strides, padding each to hide filter and
+            # resampling transients at the joins, all aligned to the
+            # sample period (e.g. 60 seconds for minute trends)
+            if nds:
+                stride = globalv.READ_STRIDE or globalv.NDS_STRIDE
+            else:
+                stride = globalv.READ_STRIDE
+            chunks = _split_segment(segment, stride, align=period)
+            if len(chunks) == 1 or not pad:
+                readsegs = chunks
+            else:
+                readsegs = [c.protract(pad) & segment for c in chunks]
             if nds:
-                tsd = DictClass.fetch(qchannels, segment[0], segment[1],
-                                      connection=ndsconnection, type=ndstype,
-                                      **ioargs)
+                tsds = iter_fetch(qchannels, readsegs, host=ndshost,
+                                  port=ndsport, type=ndstype,
+                                  DictClass=DictClass,
+                                  nthreads=ndsthreads,
+                                  nchannels=globalv.NDS_MAX_CHANNELS, **ioargs)
             else:
-                # pad resampling
-                if segment[1] == cachesegments[-1][1] and qresample:
-                    resamplepad = 8
-                    if abs(segment) <= resamplepad:
-                        continue
-                    segment = type(segment)(segment[0],
-                                            segment[1] - resamplepad)
-                    segcache = fcache.sieve(
-                                   segment=segment.protract(resamplepad))
+                if i + 1 < len(new):
+                    nextcache = fcache.sieve(segment=new[i+1])
                 else:
-                    segcache = fcache.sieve(segment=segment)
-                tsd = DictClass.read(segcache, qchannels, format='lcf',
-                                     start=float(segment[0]),
-                                     end=float(segment[1]), type=ctype,
-                                     nproc=nproc, resample=qresample,
-                                     verbose=verbose, **ioargs)
-            for (channel, data) in tsd.iteritems():
-                if (channel.ndsname in globalv.DATA and
-                    data.span in globalv.DATA[channel.ndsname].segments):
-                    continue
-                for seg in globalv.DATA[channel.ndsname].segments:
-                    if seg.intersects(data.span):
-                        data = data.crop(*(data.span - seg))
-                        break
-                data.channel = channel
-                if channel.ndsname in filter_:
-                    data = data.filter(*filter_[channel.ndsname])
-                if isinstance(data, StateVector):
-                    data.unit = units.dimensionless_unscaled
-                    if hasattr(channel, 'bits'):
-                        data.bits = channel.bits
-                # XXX: HACK for failing unit check
-                globalv.DATA[channel.ndsname].append(data)
-                try:
-                    globalv.DATA[channel.ndsname].coalesce()
-                except ValueError as e:
-                    if not 'units do not match' in str(e):
-                        raise
-                    warnings.warn(str(e))
-                    globalv.DATA[channel.ndsname][-1].unit = (
-                        globalv.DATA[channel.ndsname][0].unit)
-                    globalv.DATA[channel.ndsname].coalesce()
-            vprint('.')
+                    nextcache = None
+                tsds = _iter_read(DictClass, fcache, qchannels, readsegs,
+                                  pad=cachepad, nextcache=nextcache,
+                                  format='lcf', type=ctype, nproc=nproc,
+                                  resample=qresample, verbose=verbose,
+                                  **ioargs)
+            for chunk, readseg, tsd in izip(chunks, readsegs, tsds):
+                for (channel, data) in tsd.iteritems():
+                    if channel.ndsname in filter_:
+                        data = data.filter(*filter_[channel.ndsname])
+                    if readseg != chunk:
+                        data = data.crop(float(chunk[0]), float(chunk[1]))
+                    _add_new_data(channel, data)
+                vprint('.')
+        for channel in qchannels:
+            _coalesce_data(channel.ndsname)
         if len(new):
             vprint("\n")
 
@@ -615,19 +800,139 @@ def _get_timeseries_dict(channels, segments, config=ConfigParser(),
     # return correct data
     out = dict()
     for channel in channels:
-        data = ListClass()
-        for ts in globalv.DATA[channel.ndsname]:
-            for seg in segments:
-                if abs(seg) == 0 or abs(seg) < ts.dt.value:
-                    continue
-                if ts.span.intersects(seg):
-                    cropped = ts.crop(float(seg[0]), float(seg[1]), copy=False)
-                    if cropped.size:
-                        data.append(cropped)
-        out[channel.ndsname] = data.coalesce()
+        out[channel.ndsname] = _crop_stored(globalv.DATA, channel.ndsname,
+                                            segments, ListClass=ListClass)
+    return out
+
+
+def _crop_stored(store, key, segments, ListClass=None):
+    """Return the stored data for a key, cropped to the given segments
+    """
+    if ListClass is None:
+        ListClass = type(store[key])
+    data = ListClass()
+    for seg in segments:
+        if abs(seg) == 0:
+            continue
+        for ts in store.overlapping(key, seg):
+            if abs(seg) < ts.dt.value:
+                continue
+            cropped = ts.crop(float(seg[0]), float(seg[1]), copy=False)
+            if cropped.size:
+                data.append(cropped)
+    return data.coalesce()
+
+
+def _iter_read(DictClass, cache, channels, segments, pad=0, nextcache=None,
+               **kwargs):
+    """Read data from frames for each segment in turn
+
+    While each segment is being read and processed, the files for the
+    next segment (or those in ``nextcache`` after the last segment) are
+    read ahead in the background, see :func:`gwsumm.frames.read_ahead`.
+    """
+    for i, seg in enumerate(segments):
+        segcache = cache.sieve(segment=seg.protract(pad))
+        if i + 1 < len(segments):
+            read_ahead(cache.sieve(segment=segments[i+1].protract(pad)))
+        elif nextcache is not None:
+            read_ahead(nextcache)
+        yield DictClass.read(segcache, channels, start=float(seg[0]),
+                             end=float(seg[1]), **kwargs)
+
+
+def _split_segment(segment, stride=None, align=1):
+    """Split a segment into a list of strides of the given duration
+
+    If ``stride`` is `None` the segment is returned whole. Otherwise the
+    stride is rounded up to a multiple of ``align``, and the joins
+    between strides are placed on multiples of the stride in GPS time.
+    """
+    if not stride:
+        return [segment]
+    stride = ceil(stride / float(align)) * align
+    out = []
+    t = segment[0]
+    while t < segment[1]:
+        end = (floor(t / stride) + 1) * stride
+        out.append(type(segment)(t, min(end, segment[1])))
+        t = end
     return out
 
 
+def _align_segments(segments, align):
+    """Shrink each segment to start and end on multiples of ``align``
+
+    Segments that don't contain a whole multiple are removed.
+    """
+    if not align:
+        return segments
+    out = type(segments)()
+    for seg in segments:
+        start = ceil(round(float(seg[0]) / align, 6)) * align
+        end = floor(round(float(seg[1]) / align, 6)) * align
+        if end > start:
+            out.append(type(seg)(start, end))
+    return out
+
+
+def _sample_period(channels, frametype=None, minimum=1):
+    """Return the sample period (seconds) to which reads should be aligned
+
+    This is the longest sample period of the given channels, or
+    ``minimum`` if that is longer.
+    """
+    period = minimum
+    for channel in channels:
+        try:
+            rate = channel.sample_rate.value
+        except AttributeError:
+            rate = channel.sample_rate
+        if rate:
+            period = max(period, 1 / float(rate))
+        if channel.type == 'm-trend':
+            period = max(period, 60)
+    if frametype is not None and frametype.endswith('_M'):
+        period = max(period, 60)
+    return period
+
+
+def _add_new_data(channel, data):
+    """Record new data for the given channel in the global memory
+
+    The data list is not coalesced, see :func:`_coalesce_data`.
+    """
+    havesegs = globalv.DATA.segments(channel.ndsname)
+    if data.span in havesegs:
+        return
+    for seg in havesegs:
+        if seg.intersects(data.span):
+            data = data.crop(*(data.span - seg))
+            break
+    data.channel = channel
+    if isinstance(data, StateVector):
+        data.unit = units.dimensionless_unscaled
+        if hasattr(channel, 'bits'):
+            data.bits = channel.bits
+    globalv.DATA.append(channel.ndsname, data, coalesce=False)
+
+
+def _coalesce_data(key):
+    """Coalesce the global memory data list for the given key
+    """
+    # XXX: HACK for failing unit check
+    try:
+        globalv.DATA.coalesce(key)
+    except ValueError as e:
+        if not 'units do not match' in str(e):
+            raise
+        warnings.warn(str(e))
+        for ts in globalv.DATA[key][1:]:
+            ts.unit = globalv.DATA[key][0].unit
+        globalv.DATA.coalesce(key)
+    globalv.DATA.enforce_budget(key)
+
+
 def get_timeseries(channel, segments, config=ConfigParser(), cache=None,
                    query=True, nds='guess', multiprocess=True,
                    statevector=False, return_=True):
@@ -654,30 +959,39 @@ def get_spectrogram(channel, segments, config=ConfigParser(), cache=None,
     channel = get_channel(channel)
 
     # find meta-channels
-    specs = []
-    channels = re_channel.findall(channel.ndsname)
-    for c in channels:
-        specs.append(_get_spectrogram(c, segments, config=config, cache=cache,
-                                      query=query, nds=nds, format=format,
-                                      return_=return_,
-                                      multiprocess=multiprocess,
-                                      **fftparams))
-    if return_:
-        # build meta-spectrogram
-        out = SpectrogramList()
-        operators = [channel.name[m.span()[1]] for m in
-                     list(re_channel.finditer(channel.ndsname))[:-1]]
-        for i in range(len(specs[0])):
-            out.append(specs[0][i].copy())
-            out[-1].name = str(channel)
-            for op, spec in zip(operators, specs[1:]):
-                try:
-                    op = OPERATOR[op]
-                except KeyError as e:
-                    e.args = ('Cannot parse math operator %r' % op,)
-                    raise
-                out[-1] = op(out[-1], spec[i])
-        return out
+    expression = parse_expression(channel.ndsname)
+    kwargs = dict(config=config, cache=cache, nds=nds, format=format,
+                  multiprocess=multiprocess)
+    kwargs.update(fftparams)
+    if expression.trivial:
+        return _get_spectrogram(expression.channels[0], segments, query=query,
+                                return_=return_, **kwargs)
+    for c in expression.channels:
+        _get_spectrogram(c, segments, query=query, return_=False, **kwargs)
+    if not return_:
+        return
+
+    # evaluate meta-channel for new times, and store the result
+    key = '%s,%s,%s' % (channel.ndsname,
+                        fftparams.get('method', 'median-mean'), format)
+    globalv.DERIVED.setdefault(key, SpectrogramList())
+    new = segments - globalv.DERIVED.segments(key)
+    if abs(new):
+        specs = [_get_spectrogram(c, new, query=False, **kwargs) for
+                 c in expression.channels]
+        for pieces in zip(*specs):
+            globalv.DERIVED.append(key, expression(*pieces), coalesce=False)
+        globalv.DERIVED.coalesce(key)
+        globalv.DERIVED.enforce_budget(key)
+    out = SpectrogramList()
+    for seg in segments:
+        for specgram in globalv.DERIVED.overlapping(key, seg):
+            if abs(seg) < specgram.dt.value:
+                continue
+            s = specgram.crop(*seg)
+            if s.shape[0]:
+                out.append(s)
+    return out.coalesce()
 
 
 def _get_spectrogram(channel, segments, config=ConfigParser(), cache=None,
@@ -690,8 +1004,7 @@ def _get_spectrogram(channel, segments, config=ConfigParser(), cache=None,
         method = format
     key = '%s,%s' % (channel.ndsname, method)
     # read segments from global memory
-    havesegs = globalv.SPECTROGRAMS.get(key,
-                                        SpectrogramList()).segments
+    havesegs = globalv.SPECTROGRAMS.segments(key)
     new = segments - havesegs
 
     # get processes
@@ -717,6 +1030,12 @@ def _get_spectrogram(channel, segments, config=ConfigParser(), cache=None,
 
         # read FFT params
         fftparams = fftparams.copy()
+        engine = fftparams.pop('engine', 'gwpy')
+        dtype = fftparams.pop('dtype', None)
+        # only keep the plotted band, unless a spectrum is needed
+        frange = get_spectrogram_band(channel, method=method,
+                                   crop=fftparams.pop('crop', False))
+        globalv.SPECTROGRAM_BANDS[key] = frange
         for param in ['fftlength', 'overlap']:
             if hasattr(channel, param):
                 fftparams[param] = float(getattr(channel, param))
@@ -743,9 +1062,26 @@ def _get_spectrogram(channel, segments, config=ConfigParser(), cache=None,
                 stride = fftparams['fftlength']
             if abs(ts.span) < stride:
                 continue
+            # only whole strides from the start of the new data are stored,
+            # so when a segment grows (e.g. in live mode) the next call
+            # starts at the end of the last whole stride, and re-uses the
+            # trailing data already held in memory, rather than computing
+            # again from the segment start
+            # use the in-process engine where it agrees with gwpy
+            inprocess = (engine == 'gwsumm' and method not in ['rayleigh'] and
+                         spectral.check_spectrogram(
+                             ts, stride, fftparams['fftlength'],
+                             overlap=fftparams['overlap'], method=method,
+                             window=fftparams.get('window', 'hann')))
             try:
-                specgram = ts.spectrogram(stride, nproc=nproc, method=method,
-                                          **fftparams)
+                if inprocess:
+                    specgram = spectral.spectrogram(
+                        ts, stride, fftparams['fftlength'],
+                        overlap=fftparams['overlap'], method=method,
+                        window=fftparams.get('window', 'hann'))
+                else:
+                    specgram = ts.spectrogram(stride, nproc=nproc,
+                                              method=method, **fftparams)
             except ZeroDivisionError:
                 if stride == 0:
                     raise ZeroDivisionError("Spectrogram stride is 0")
@@ -763,9 +1099,15 @@ def _get_spectrogram(channel, segments, config=ConfigParser(), cache=None,
                     raise
             if filter_ and method not in ['rayleigh']:
                 specgram = (specgram ** (1/2.)).filter(*filter_, inplace=True) ** 2
-            globalv.SPECTROGRAMS[key].append(specgram)
-            globalv.SPECTROGRAMS[key].coalesce()
+            if frange is not None:
+                specgram = specgram.crop_frequencies(*frange,
+                                                     copy=dtype is None)
+            if dtype is not None:
+                specgram = specgram.astype(dtype, copy=False)
+            globalv.SPECTROGRAMS.append(key, specgram, coalesce=False)
             vprint('.')
+        globalv.SPECTROGRAMS.coalesce(key)
+        globalv.SPECTROGRAMS.enforce_budget(key)
         if len(timeserieslist):
             vprint('\n')
 
@@ -774,24 +1116,131 @@ def _get_spectrogram(channel, segments, config=ConfigParser(), cache=None,
 
     # return correct data
     out = SpectrogramList()
-    for specgram in globalv.SPECTROGRAMS[key]:
-        for seg in segments:
+    for seg in segments:
+        for specgram in globalv.SPECTROGRAMS.overlapping(key, seg):
             if abs(seg) < specgram.dt.value:
                 continue
-            if specgram.span.intersects(seg):
-                if format in ['amplitude', 'asd']:
-                    s = specgram.crop(*seg) ** (1/2.)
-                else:
-                    s = specgram.crop(*seg)
-                    # XXX FIXME: this corrects the bias offset in Rayleigh
-                    if format in ['rayleigh']:
-                        med = numpy.median(s.data)
-                        s /= med
-                if s.shape[0]:
-                    out.append(s)
+            if format in ['amplitude', 'asd']:
+                s = specgram.crop(*seg) ** (1/2.)
+            else:
+                s = specgram.crop(*seg)
+                # XXX FIXME: this corrects the bias offset in Rayleigh
+                if format in ['rayleigh']:
+                    med = numpy.median(s.data)
+                    s /= med
+            if s.shape[0]:
+                out.append(s)
     return out.coalesce()
 
 
+def get_spectrogram_band(channel, method='median-mean', crop=False):
+    """Return the frequency band to which spectrograms of a channel are
+    cropped
+
+    Returns
+    -------
+    band : `tuple`, `None`
+        the ``(low, high)`` frequency range of the channel, or `None` if
+        the full band is kept, because ``crop`` is `False`, the
+        spectrogram is a Rayleigh statistic (which is normalised over the
+        full band), or the channel is shown in a spectrum plot
+    """
+    channel = get_channel(channel)
+    if (not crop or method in ['rayleigh'] or
+            channel.ndsname in globalv.FULL_BAND_SPECTRA or
+            channel.name in globalv.FULL_BAND_SPECTRA):
+        return None
+    frange = getattr(channel, 'frequency_range', None)
+    if isinstance(frange, str):
+        frange = eval(frange)
+    return frange
+
+
+def get_decimated_spectrogram(channel, segments, resolution, format='power',
+                              **kwargs):
+    """Retrieve a time-decimated spectrogram of the given channel
+
+    Each level of the spectrogram pyramid averages blocks of
+    ``PYRAMID_FACTOR ** k`` strides of the stored spectrogram, and is
+    built when first needed and kept in `globalv.SPECTROGRAM_PYRAMID`.
+    The coarsest level whose stride is no longer than ``resolution`` is
+    returned, with any times not covered by a whole block filled from
+    the stored spectrogram.
+
+    Parameters
+    ----------
+    channel : `~gwpy.detector.Channel`, `str`
+        the channel of interest
+    segments : `~gwpy.segments.SegmentList`, `DataQualityFlag`
+        the segments of interest
+    resolution : `float`
+        the longest acceptable stride (seconds), e.g. the duration
+        covered by one pixel of a plot
+    format : `str`, optional, default: ``'power'``
+        the format of the returned spectrogram
+    **kwargs
+        other keyword arguments to pass to :func:`get_spectrogram`
+
+    Returns
+    -------
+    speclist : `~gwpy.spectrogram.SpectrogramList`
+        the list of spectrograms, in time order
+    """
+    if isinstance(segments, DataQualityFlag):
+        segments = segments.active
+    channel = get_channel(channel)
+    kwargs['query'] = False
+    method = kwargs.get('method', 'median-mean')
+    expression = parse_expression(channel.ndsname)
+    basekey = '%s,%s' % (get_channel(expression.channels[0]).ndsname, method)
+    try:
+        dt = globalv.SPECTROGRAMS[basekey][0].dt.value
+    except (KeyError, IndexError):
+        dt = None
+    if (format in ['rayleigh'] or dt is None or
+            resolution < dt * PYRAMID_FACTOR):
+        return get_spectrogram(channel, segments, format=format, **kwargs)
+    factor = PYRAMID_FACTOR ** int(floor(log(resolution / dt, PYRAMID_FACTOR)))
+
+    # decimate the stored data for any times not yet in this level
+    key = '%s,%s,%d' % (channel.ndsname, method, factor)
+    store = globalv.SPECTROGRAM_PYRAMID
+    store.setdefault(key, SpectrogramList())
+    new = segments - store.segments(key)
+    if abs(new):
+        if expression.trivial:
+            pieces = ((specgram, seg) for seg in new for specgram in
+                      globalv.SPECTROGRAMS.overlapping(basekey, seg))
+        else:
+            pieces = ((specgram, specgram.span) for specgram in
+                      get_spectrogram(channel, new, format='power', **kwargs))
+        for specgram, seg in pieces:
+            if not specgram.span.intersects(seg):
+                continue
+            decimated = spectral.decimate_spectrogram(
+                specgram.crop(*(specgram.span & seg)), factor)
+            if decimated is not None:
+                store.append(key, decimated, coalesce=False)
+        store.coalesce(key)
+        store.enforce_budget(key)
+
+    # return decimated data, and stored data for the remainder
+    out = SpectrogramList()
+    for seg in segments:
+        for specgram in store.overlapping(key, seg):
+            if abs(seg) >= specgram.dt.value:
+                s = specgram.crop(*seg)
+                if format in ['amplitude', 'asd']:
+                    s = s ** (1/2.)
+                out.append(s)
+    rest = segments - store.segments(key)
+    if abs(rest):
+        out.extend(get_spectrogram(channel, rest, format=format, **kwargs))
+    out = SpectrogramList(s for s in out if s.shape[0])
+    out.sort(key=lambda s: s.span[0])
+    return out
+
+
 def get_spectrum(channel, segments, config=ConfigParser(), cache=None,
                  query=True, nds='guess', format='power', return_=True,
                  **fftparams):
@@ -804,55 +1253,89 @@ def get_spectrum(channel, segments, config=ConfigParser(), cache=None,
         segments = segments.active
     else:
         name = channel.ndsname
+    name = '%s,%s' % (name, format)
     cmin = '%s.min' % name
     cmax = '%s.max' % name
 
     if name not in globalv.SPECTRUM:
         vprint("    Calculating 5/50/95 percentile spectra for %s"
-               % name.rsplit(',', 1)[0])
-        speclist = get_spectrogram(channel, segments, config=config,
-                                   cache=cache, query=False, nds=nds,
-                                   format=format, **fftparams)
-        try:
-            specgram = speclist.join(gap='ignore')
-        except ValueError as e:
-            if 'units do not match' in str(e):
-                warnings.warn(str(e))
-                for spec in speclist[1:]:
-                    spec.unit = speclist[0].unit
-                specgram = speclist.join(gap='ignore')
+               % name.split(',', 1)[0])
+        # sketched channels are counted in day jobs, and long-span jobs
+        # merge the daily sketches rather than reading the spectrograms
+        sketch = None
+        if (format not in ['rayleigh'] and
+                channel.ndsname in globalv.SKETCH_SPECTRA):
+            skey = '%s,%s' % (name.rsplit(',', 1)[0],
+                              fftparams.get('method', 'median-mean'))
+            if globalv.MODE == SUMMARY_MODE_DAY:
+                sketch = _update_sketch(channel, segments, skey,
+                                        config=config, cache=cache, nds=nds,
+                                        **fftparams)
             else:
-                raise
+                sketch = globalv.SPECTRUM_SKETCHES.get(skey)
+        if sketch is None or globalv.MODE == SUMMARY_MODE_DAY:
+            speclist = get_spectrogram(channel, segments, config=config,
+                                       cache=cache, query=False, nds=nds,
+                                       format=format, **fftparams)
+        else:
+            speclist = SpectrogramList()
+        for spec in speclist[1:]:
+            if spec.unit != speclist[0].unit:
+                warnings.warn("Spectrogram units do not match for %s"
+                              % str(channel))
+                spec.unit = speclist[0].unit
         try:
-            globalv.SPECTRUM[name] = specgram.percentile(50)
-        except (ValueError, IndexError):
+            # use the exact spectrograms, unless the sketch includes
+            # times for which they aren't available
+            covered = SegmentList(s.span for s in speclist).coalesce()
+            if (sketch is not None and
+                    abs((sketch.segments & segments) - covered)):
+                spectra = sketch.percentiles([5, 50, 95])
+                if format in ['amplitude', 'asd']:
+                    spectra = [s ** (1/2.) for s in spectra]
+            else:
+                spectra = spectral.percentile_spectra(speclist, [5, 50, 95])
+        except ValueError:
             globalv.SPECTRUM[name] = Spectrum([], channel=channel, f0=0, df=1)
             globalv.SPECTRUM[cmin] = globalv.SPECTRUM[name]
             globalv.SPECTRUM[cmax] = globalv.SPECTRUM[name]
         else:
-            globalv.SPECTRUM[cmin] = specgram.percentile(5)
-            globalv.SPECTRUM[cmax] = specgram.percentile(95)
+            (globalv.SPECTRUM[cmin], globalv.SPECTRUM[name],
+             globalv.SPECTRUM[cmax]) = spectra
         vprint(".\n")
 
     if not return_:
         return
 
-    cmin = '%s.min' % name
-    cmax = '%s.max' % name
     out = (globalv.SPECTRUM[name], globalv.SPECTRUM[cmin],
            globalv.SPECTRUM[cmax])
     return out
 
 
+def _update_sketch(channel, segments, key, **kwargs):
+    """Count any new power spectrogram strides in the sketch for ``key``
+    """
+    sketch = globalv.SPECTRUM_SKETCHES.setdefault(
+        key, spectral.SpectrumSketch())
+    new = segments - sketch.segments
+    if abs(new):
+        for specgram in get_spectrogram(channel, new, query=False,
+                                        format='power', **kwargs):
+            try:
+                sketch.update(specgram)
+            except ValueError as e:
+                warnings.warn(str(e))
+    return sketch
+
+
 def add_timeseries(timeseries, key=None, coalesce=True):
     """Add a `TimeSeries` to the global memory cache
     """
     if key is None:
         key = timeseries.name or timeseries.channel.ndsname
     globalv.DATA.setdefault(key, TimeSeriesList())
-    globalv.DATA[key].append(timeseries)
-    if coalesce:
-        globalv.DATA[key].coalesce()
+    globalv.DATA.append(key, timeseries, coalesce=coalesce)
+    globalv.DATA.enforce_budget(key)
 
 
 def add_spectrogram(specgram, key=None, coalesce=True):
@@ -861,7 +1344,6 @@ def add_spectrogram(specgram, key=None, coalesce=True):
     if key is None:
         key = specgram.name or str(specgram.channel)
     globalv.SPECTROGRAMS.setdefault(key, SpectrogramList())
-    globalv.SPECTROGRAMS[key].append(specgram)
-    if coalesce:
-        globalv.SPECTROGRAMS[key].coalesce()
+    globalv.SPECTROGRAMS.append(key, specgram, coalesce=coalesce)
+    globalv.SPECTROGRAMS.enforce_budget(key)
 
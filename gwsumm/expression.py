@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Duncan Macleod (2013)
+#
+# This file is part of GWSumm.
+#
+# GWSumm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GWSumm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GWSumm.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Parsing and evaluation of meta-channel arithmetic
+
+A meta-channel is either a single channel combined with a constant, e.g.
+``'L1:TEST-CHANNEL * 2'``, or a number of channels joined by operators,
+e.g. ``'L1:TEST-CHANNEL_A+L1:TEST-CHANNEL_B'``. Operations are applied
+strictly from left to right, without operator precedence.
+"""
+
+import numpy
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+from . import version
+from .utils import re_channel
+
+__author__ = 'Duncan Macleod <duncan.macleod@ligo.org>'
+__version__ = version.version
+
+UFUNC = {
+    '*': numpy.multiply,
+    '-': numpy.subtract,
+    '+': numpy.add,
+    '/': numpy.true_divide,
+}
+
+_EXPRESSIONS = {}
+
+
+class Expression(object):
+    """A parsed meta-channel expression
+
+    Parameters
+    ----------
+    name : `str`
+        the meta-channel name to parse
+
+    Attributes
+    ----------
+    channels : `list` of `str`
+        the names of the channels used in this expression, in order
+    terms : `list` of `tuple`
+        ``(operator, operand)`` pairs to apply to the first channel, in
+        order, where each operand is either the index of another channel
+        in ``channels``, or a `float` constant
+
+    Raises
+    ------
+    KeyError
+        if an operator in the expression cannot be parsed
+    """
+    def __init__(self, name):
+        self.name = name
+        self.channels = re_channel.findall(name)
+        self.terms = []
+        if len(self.channels) == 1 and len(name) != len(self.channels[0]):
+            stub = name[len(self.channels[0]):].strip(' ')
+            self.terms.append((_parse_operator(stub[0]), float(stub[1:])))
+        elif len(self.channels) > 1:
+            matches = list(re_channel.finditer(name))[:-1]
+            for i, m in enumerate(matches):
+                self.terms.append((_parse_operator(name[m.span()[1]]), i + 1))
+        self._numexpr = 'x0'
+        for op, operand in self.terms:
+            if isinstance(operand, int):
+                self._numexpr = '(%s %s x%d)' % (self._numexpr, op, operand)
+            else:
+                self._numexpr = '(%s %s %r)' % (self._numexpr, op, operand)
+
+    @property
+    def trivial(self):
+        """`True` if this expression is just a single channel
+        """
+        return not self.terms
+
+    def __call__(self, *series):
+        """Evaluate this expression for one piece of data per channel
+
+        The result is built in a single new array, with all operations
+        applied in place, using :mod:`numexpr` if available.
+
+        Parameters
+        ----------
+        *series : `~gwpy.data.Array`
+            one array for each channel in this expression, all of the
+            same shape
+
+        Returns
+        -------
+        result : `~gwpy.data.Array`
+            a new array, with the metadata of the first input
+
+        Raises
+        ------
+        astropy.units.UnitsError
+            if channels with incompatible units are added or subtracted
+        """
+        # promote to float for constants and division, as with `Quantity`
+        dtypes = [numpy.asarray(s).dtype for s in series]
+        if any(not isinstance(o, int) or op == '/' for (op, o) in self.terms):
+            dtypes.append(numpy.dtype(float))
+        unit, scales = self._combine_units(
+            *[getattr(s, 'unit', None) for s in series])
+        if any(scale != 1 for scale in scales):
+            dtypes.append(numpy.dtype(float))
+        dtype = numpy.result_type(*dtypes)
+        out = series[0].astype(dtype)
+        raw = out.view(numpy.ndarray)
+        # operands added or subtracted in other units are converted first
+        operands = dict((i, numpy.asarray(s)) for (i, s) in enumerate(series))
+        for (_, operand), scale in zip(self.terms, scales):
+            if scale != 1:
+                operands[operand] = operands[operand] * scale
+        if numexpr is not None and dtype.kind in 'fc':
+            local = dict(('x%d' % i, a) for (i, a) in operands.iteritems())
+            local['x0'] = raw
+            numexpr.evaluate(self._numexpr, local_dict=local, out=raw)
+        else:
+            for op, operand in self.terms:
+                if isinstance(operand, int):
+                    operand = operands[operand]
+                UFUNC[op](raw, operand, out=raw)
+        out.unit = unit
+        out.name = self.name
+        return out
+
+    def unit(self, *units):
+        """Return the unit of the result of this expression
+
+        Parameters
+        ----------
+        *units : `~astropy.units.Unit`
+            the unit of each channel in this expression
+
+        Raises
+        ------
+        astropy.units.UnitsError
+            if channels with incompatible units are added or subtracted
+        """
+        return self._combine_units(*units)[0]
+
+    def _combine_units(self, *units):
+        """Return the unit of the result, and the scale to apply to each term
+
+        Operands that are added or subtracted must be converted to the
+        unit of the result so far, as with `~astropy.units.Quantity`.
+        """
+        unit = units[0]
+        scales = []
+        for op, operand in self.terms:
+            scale = 1
+            if (unit is not None and isinstance(operand, int) and
+                    units[operand] is not None):
+                if op in ['+', '-']:
+                    scale = units[operand].to(unit)
+                elif op == '*':
+                    unit = unit * units[operand]
+                else:
+                    unit = unit / units[operand]
+            scales.append(scale)
+        return unit, scales
+
+    def __repr__(self):
+        return '<Expression(%r)>' % self.name
+
+
+def _parse_operator(op):
+    if op not in UFUNC:
+        raise KeyError('Cannot parse math operator %r' % op)
+    return op
+
+
+def parse_expression(name):
+    """Parse a meta-channel name into an `Expression`
+
+    Each name is only parsed once, with the result stored for re-use.
+    """
+    try:
+        return _EXPRESSIONS[name]
+    except KeyError:
+        _EXPRESSIONS[name] = Expression(name)
+        return _EXPRESSIONS[name]
@@ -0,0 +1,533 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Duncan Macleod (2013)
+#
+# This file is part of GWSumm.
+#
+# GWSumm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GWSumm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GWSumm.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Utilities for finding GWF frame files
+"""
+
+import httplib
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+try:
+    from configparser import (ConfigParser, NoSectionError, NoOptionError)
+except ImportError:
+    from ConfigParser import (ConfigParser, NoSectionError, NoOptionError)
+
+from glue import datafind
+from glue.lal import (Cache, CacheEntry)
+
+from gwpy.segments import (Segment, SegmentList)
+
+from . import version
+
+__author__ = 'Duncan Macleod <duncan.macleod@ligo.org>'
+__version__ = version.version
+
+
+class DatafindConnectionPool(object):
+    """Process-wide pool of open datafind server connections
+
+    Connections are kept open (HTTP keep-alive) after each query and
+    handed back out for the next, and the X509 credentials for secure
+    connections are only discovered once per process.
+    """
+    def __init__(self):
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._credential = None
+
+    def credential(self):
+        """Find the X509 certificate and key to use for connections
+        """
+        with self._lock:
+            if self._credential is None:
+                self._credential = datafind.find_credential()
+        return self._credential
+
+    def _connect(self, host, port):
+        if not port == 80:
+            cert, key = self.credential()
+        else:
+            cert, key = None, None
+        if cert and key:
+            return datafind.GWDataFindHTTPSConnection(host=host, port=port,
+                                                      cert_file=cert,
+                                                      key_file=key)
+        else:
+            return datafind.GWDataFindHTTPConnection(host=host, port=port)
+
+    @contextmanager
+    def connection(self, host=None, port=None):
+        """Borrow a connection to the given server
+
+        The connection is returned to the pool when the context exits
+        cleanly, and is closed and discarded if an exception is raised.
+        If a re-used connection has since been closed by the server, the
+        first query made with it is retried once on a new connection.
+        """
+        with self._lock:
+            try:
+                conn = self._idle.get((host, port), []).pop()
+            except IndexError:
+                conn = None
+        if conn is None:
+            proxy = _PooledConnection(self, host, port,
+                                      self._connect(host, port), False)
+        else:
+            proxy = _PooledConnection(self, host, port, conn, True)
+        try:
+            yield proxy
+        except:
+            proxy.conn.close()
+            raise
+        with self._lock:
+            self._idle.setdefault((host, port), []).append(proxy.conn)
+
+    def close(self):
+        """Close all idle connections
+        """
+        with self._lock:
+            for conns in self._idle.values():
+                for conn in conns:
+                    conn.close()
+            self._idle = {}
+
+
+class _PooledConnection(object):
+    """Proxy for a connection borrowed from a `DatafindConnectionPool`
+
+    Servers close idle keep-alive connections after a few seconds, which
+    is only found out when the connection is next used, so if the first
+    query with a re-used connection fails, it is retried once on a new
+    connection.
+    """
+    def __init__(self, pool, host, port, conn, reused):
+        self.pool = pool
+        self.host = host
+        self.port = port
+        self.conn = conn
+        self.reused = reused
+
+    def __getattr__(self, attr):
+        value = getattr(self.conn, attr)
+        if not callable(value):
+            return value
+
+        def call(*args, **kwargs):
+            try:
+                out = getattr(self.conn, attr)(*args, **kwargs)
+            except (httplib.HTTPException, socket.error, RuntimeError) as e:
+                if not self.reused or (isinstance(e, RuntimeError) and
+                                       'Unable to query' not in str(e)):
+                    raise
+                self.conn.close()
+                self.conn = self.pool._connect(self.host, self.port)
+                out = getattr(self.conn, attr)(*args, **kwargs)
+            self.reused = False
+            return out
+        return call
+
+
+DATAFIND_POOL = DatafindConnectionPool()
+
+
+def get_datafind_server(config=ConfigParser()):
+    """Find the datafind server host and port for this job
+
+    The ``[datafind]`` section of the configuration is used if given,
+    otherwise the ``LIGO_DATAFIND_SERVER`` environment variable.
+
+    Returns
+    -------
+    host, port : `str`, `int`
+        the server host name and port, both `None` if unknown
+    """
+    try:
+        host = config.get('datafind', 'server')
+    except (NoOptionError, NoSectionError):
+        try:
+            host = os.environ['LIGO_DATAFIND_SERVER']
+        except KeyError:
+            return None, None
+        else:
+            host, port = host.split(':')
+            return host, int(port)
+    else:
+        return host, config.getint('datafind', 'port')
+
+
+def datafind_connection(config=ConfigParser()):
+    """Borrow a connection to the datafind server from the global pool
+
+    This should be used as a context manager::
+
+        >>> with datafind_connection(config) as conn:
+        ...     conn.find_types()
+    """
+    return DATAFIND_POOL.connection(*get_datafind_server(config))
+
+
+class FileExistenceCache(object):
+    """Short-lived record of which files exist on disk
+
+    Files are checked with a pool of threads, hiding the latency of each
+    ``stat`` on network file systems, and each result is remembered for
+    ``ttl`` seconds so that repeated checks of the same cache (for each
+    tab and state) are free.
+
+    Parameters
+    ----------
+    ttl : `float`, optional, default: 600
+        time-to-live (seconds) of each result
+    nthreads : `int`, optional, default: 16
+        number of threads with which to check files
+    """
+    def __init__(self, ttl=600, nthreads=16):
+        self.ttl = ttl
+        self.nthreads = nthreads
+        self._lock = threading.Lock()
+        self._found = {}
+
+    def check(self, cache):
+        """Find which entries in a cache exist on disk
+
+        Parameters
+        ----------
+        cache : `~glue.lal.Cache`
+            cache of files to check
+
+        Returns
+        -------
+        found, missed : `~glue.lal.Cache`
+            two caches of entries that do and don't exist on disk,
+            as with :meth:`glue.lal.Cache.checkfilesexist`
+        """
+        now = time.time()
+        paths = set(e.path for e in cache)
+        with self._lock:
+            known = dict((p, self._found[p][0]) for p in paths if
+                         p in self._found and
+                         now - self._found[p][1] < self.ttl)
+        unknown = sorted(paths - set(known))
+        if len(unknown) > 1 and self.nthreads > 1:
+            pool = ThreadPool(min(self.nthreads, len(unknown)))
+            try:
+                exists = pool.map(os.path.isfile, unknown)
+            finally:
+                pool.close()
+        else:
+            exists = map(os.path.isfile, unknown)
+        with self._lock:
+            for path, found in zip(unknown, exists):
+                self._found[path] = (found, now)
+                known[path] = found
+        found = type(cache)(e for e in cache if known[e.path])
+        missed = type(cache)(e for e in cache if not known[e.path])
+        return found, missed
+
+    def clear(self):
+        """Forget all results
+        """
+        with self._lock:
+            self._found = {}
+
+
+FILE_CACHE = FileExistenceCache()
+
+
+def check_files_exist(cache):
+    """Find which entries in a cache exist on disk
+
+    This is a parallel, cached replacement for
+    :meth:`glue.lal.Cache.checkfilesexist`.
+
+    Returns
+    -------
+    found, missed : `~glue.lal.Cache`
+        two caches of entries that do and don't exist on disk
+    """
+    return FILE_CACHE.check(cache)
+
+
+class FrameReadAhead(object):
+    """Background reader to warm the OS page cache with frame files
+
+    While one segment of data is being read and processed, the files for
+    the next segment can be read (and discarded) by a background thread,
+    so that they are served from memory, rather than from cold storage,
+    when they are actually needed.
+
+    Only the most recent request from each reading thread is acted upon,
+    older requests from the same thread that haven't been started are
+    dropped, so concurrent readers don't cancel each other's requests.
+
+    Parameters
+    ----------
+    maxbytes : `int`, optional, default: 256 MB
+        maximum number of bytes to read ahead for each request
+    blocksize : `int`, optional, default: 4 MB
+        size of each read
+    """
+    def __init__(self, maxbytes=256 * 1024 ** 2, blocksize=4 * 1024 ** 2):
+        self.maxbytes = maxbytes
+        self.blocksize = blocksize
+        self._pending = OrderedDict()
+        self._ready = threading.Condition(threading.Lock())
+        self._warmed = set()
+        self._thread = None
+
+    def warm(self, cache):
+        """Request that the files in the given cache be read ahead
+        """
+        if not self.maxbytes or not len(cache):
+            return
+        key = threading.current_thread().ident
+        with self._ready:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.setDaemon(True)
+                self._thread.start()
+            # replace any earlier request from this thread
+            self._pending.pop(key, None)
+            self._pending[key] = [e.path for e in cache]
+            self._ready.notify()
+
+    def _run(self):
+        while True:
+            with self._ready:
+                while not self._pending:
+                    self._ready.wait()
+                paths = self._pending.popitem(last=False)[1]
+            nbytes = 0
+            for path in paths:
+                if nbytes >= self.maxbytes:
+                    break
+                if path in self._warmed:
+                    continue
+                self._warmed.add(path)
+                try:
+                    with open(path, 'rb') as f:
+                        while nbytes < self.maxbytes:
+                            block = f.read(self.blocksize)
+                            if not block:
+                                break
+                            nbytes += len(block)
+                except IOError:
+                    continue
+
+
+READ_AHEAD = FrameReadAhead()
+
+
+def read_ahead(cache):
+    """Warm the OS page cache with the files in the given cache
+
+    This returns immediately, with the files read in a background thread.
+    """
+    READ_AHEAD.warm(cache)
+
+
+class FrameCache(object):
+    """Persistent, on-disk store of datafind query results
+
+    Frame URLs are recorded for each (ifo, frametype, urltype) key along
+    with the GPS segments for which the datafind server has already
+    returned files, so that repeated queries over a growing span (e.g. a
+    live day page) only need to ask the server for the new tail.
+
+    Coverage is only recorded for the segments spanned by the files
+    returned by the server, so that gaps (e.g. for files that hadn't been
+    written yet) are asked for again, and each coverage record expires
+    after ``ttl`` seconds, in case files are backfilled or moved.
+
+    Parameters
+    ----------
+    path : `str`
+        path of SQLite database file, will be created if required
+    ttl : `float`, optional, default: 86400
+        time-to-live (seconds) of each coverage record
+
+    Attributes
+    ----------
+    hits : `int`
+        number of requests answered entirely from the store
+    misses : `int`
+        number of datafind server queries required
+    """
+    def __init__(self, path, ttl=86400):
+        self.path = path
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        dirname = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self._lock:
+            self._db.execute('CREATE TABLE IF NOT EXISTS frames '
+                             '(ifo TEXT, frametype TEXT, urltype TEXT, '
+                             'url TEXT, start REAL, end REAL, '
+                             'PRIMARY KEY (ifo, frametype, urltype, url))')
+            # coverage records from older versions have no timestamp,
+            # so can't be trusted
+            columns = [r[1] for r in self._db.execute(
+                'PRAGMA table_info(coverage)').fetchall()]
+            if columns and 'created' not in columns:
+                self._db.execute('DROP TABLE coverage')
+            self._db.execute('CREATE TABLE IF NOT EXISTS coverage '
+                             '(ifo TEXT, frametype TEXT, urltype TEXT, '
+                             'start REAL, end REAL, created REAL)')
+            self._db.commit()
+
+    def coverage(self, ifo, frametype, urltype='file'):
+        """Return the segments for which the given key has been queried
+
+        Expired records are ignored.
+
+        Returns
+        -------
+        segments : `~gwpy.segments.SegmentList`
+            list of GPS segments already known to the store
+        """
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT start, end FROM coverage WHERE ifo=? AND '
+                'frametype=? AND urltype=? AND created>?',
+                (ifo, frametype, urltype, time.time() - self.ttl)).fetchall()
+        return SegmentList(Segment(*r) for r in rows).coalesce()
+
+    def get(self, ifo, frametype, gpsstart, gpsend, urltype='file'):
+        """Find frames in the store for the given type and span
+
+        Returns
+        -------
+        cache : `~glue.lal.Cache`
+            the cache of frame files known for this span
+        missing : `~gwpy.segments.SegmentList`
+            the list of segments for which the server must be queried
+        """
+        span = SegmentList([Segment(gpsstart, gpsend)])
+        missing = span - self.coverage(ifo, frametype, urltype)
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT url FROM frames WHERE ifo=? AND frametype=? AND '
+                'urltype=? AND end>? AND start<? ORDER BY start',
+                (ifo, frametype, urltype, gpsstart, gpsend)).fetchall()
+        cache = Cache(CacheEntry.from_T050017(r[0]) for r in rows)
+        if abs(missing):
+            self.misses += len(missing)
+        else:
+            self.hits += 1
+        return cache, missing
+
+    def put(self, ifo, frametype, gpsstart, gpsend, cache, urltype='file'):
+        """Record the result of a datafind query over the given span
+
+        Only the segments spanned by the files in the cache are recorded
+        as covered.
+        """
+        if not len(cache):
+            return
+        covered = (SegmentList(Segment(*e.segment) for e in cache).coalesce()
+                   & SegmentList([Segment(gpsstart, gpsend)]))
+        now = time.time()
+        with self._lock:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO frames VALUES (?,?,?,?,?,?)',
+                [(ifo, frametype, urltype, e.url, float(e.segment[0]),
+                  float(e.segment[1])) for e in cache])
+            self._db.executemany(
+                'INSERT INTO coverage VALUES (?,?,?,?,?,?)',
+                [(ifo, frametype, urltype, float(s[0]), float(s[1]), now)
+                 for s in covered])
+            self._db.commit()
+        self._compact(ifo, frametype, urltype)
+
+    def invalidate(self, ifo, frametype, cache, urltype='file'):
+        """Forget the given files, and the coverage of their segments
+
+        This should be called for stored files that are no longer found
+        on disk, so that the server is asked about them again.
+        """
+        if not len(cache):
+            return
+        key = (ifo, frametype, urltype)
+        lost = SegmentList(Segment(*e.segment) for e in cache).coalesce()
+        with self._lock:
+            self._db.executemany(
+                'DELETE FROM frames WHERE ifo=? AND frametype=? AND '
+                'urltype=? AND url=?', [key + (e.url,) for e in cache])
+            rows = self._db.execute(
+                'SELECT start, end, created FROM coverage WHERE ifo=? AND '
+                'frametype=? AND urltype=?', key).fetchall()
+            self._db.execute('DELETE FROM coverage WHERE ifo=? AND '
+                             'frametype=? AND urltype=?', key)
+            keep = []
+            for start, end, created in rows:
+                for seg in SegmentList([Segment(start, end)]) - lost:
+                    keep.append(key + (float(seg[0]), float(seg[1]),
+                                       created))
+            self._db.executemany('INSERT INTO coverage VALUES (?,?,?,?,?,?)',
+                                 keep)
+            self._db.commit()
+
+    def _compact(self, ifo, frametype, urltype):
+        """Coalesce the coverage records for the given key
+
+        Expired records are removed, and merged records take the
+        creation time of the oldest, so that they never outlive any part.
+        """
+        key = (ifo, frametype, urltype)
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT start, end, created FROM coverage WHERE ifo=? AND '
+                'frametype=? AND urltype=? AND created>? ORDER BY start',
+                key + (time.time() - self.ttl,)).fetchall()
+            merged = []
+            for start, end, created in rows:
+                if merged and start <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], end)
+                    merged[-1][2] = min(merged[-1][2], created)
+                else:
+                    merged.append([start, end, created])
+            self._db.execute('DELETE FROM coverage WHERE ifo=? AND '
+                             'frametype=? AND urltype=?', key)
+            self._db.executemany('INSERT INTO coverage VALUES (?,?,?,?,?,?)',
+                                 [key + tuple(m) for m in merged])
+            self._db.commit()
+
+    def clear(self):
+        """Remove all records from the store
+        """
+        with self._lock:
+            self._db.execute('DELETE FROM frames')
+            self._db.execute('DELETE FROM coverage')
+            self._db.commit()
+
+    def __repr__(self):
+        return '<FrameCache(%r, hits=%d, misses=%d)>' % (
+            self.path, self.hits, self.misses)
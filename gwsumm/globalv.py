@@ -24,16 +24,37 @@ import time
 
 from gwpy.time import tconvert
 from gwpy.segments import DataQualityDict
-from gwpy.detector import ChannelList
 
-CHANNELS = ChannelList()
+from .channels import ChannelRegistry
+from .store import DataStore
+
+CHANNELS = ChannelRegistry()
 STATES = {}
 
-DATA = {}
-SPECTROGRAMS = {}
+DATA = DataStore()
+SPECTROGRAMS = DataStore()
 SPECTRUM = {}
+SPECTRUM_SKETCHES = {}
+# channels whose percentile spectra are sketched in day jobs, and merged
+# from the daily sketches in long-span jobs
+SKETCH_SPECTRA = set()
+# channels whose spectrograms must not be cropped in frequency
+FULL_BAND_SPECTRA = set()
+# frequency band to which each key of SPECTROGRAMS is cropped (if any)
+SPECTROGRAM_BANDS = {}
 SEGMENTS = DataQualityDict()
-TRIGGERS = {}
+TRIGGERS = DataStore(spill=False)
+FRAMES = {}
+
+# derived meta-channel data, not archived
+DERIVED = DataStore()
+
+# time-decimated spectrograms for plotting, not archived
+SPECTROGRAM_PYRAMID = DataStore()
+
+# persistent caches
+CHANNEL_CACHE = None
+FRAME_CACHE = None
 
 VERBOSE = False
 PROFILE = False
@@ -41,6 +62,12 @@ START = time.time()
 
 # run time variables
 MODE = 4
+READ_STRIDE = None
+READ_PAD = 8
+FETCH_THREADS = 4
+NDS_STRIDE = 3600
+NDS_THREADS = 4
+NDS_MAX_CHANNELS = 32
 WRITTEN_PLOTS = []
 NOW = tconvert('now').seconds
 
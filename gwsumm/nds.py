@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Duncan Macleod (2013)
+#
+# This file is part of GWSumm.
+#
+# GWSumm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GWSumm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GWSumm.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Utilities for fetching data from NDS2 servers
+"""
+
+import threading
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+import nds2
+
+from gwpy.segments import (Segment, SegmentList)
+from gwpy.timeseries import TimeSeriesDict
+
+from . import version
+
+__author__ = 'Duncan Macleod <duncan.macleod@ligo.org>'
+__version__ = version.version
+
+
+class NDSConnectionPool(object):
+    """Process-wide pool of open NDS2 server connections
+
+    An `nds2.connection` can only serve one request at a time, so each
+    thread borrows its own connection, which is handed back to the pool
+    for re-use once the request is complete.
+    """
+    def __init__(self):
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._kinit = threading.Lock()
+
+    def _connect(self, host, port):
+        try:
+            return nds2.connection(host, port)
+        except RuntimeError as e:
+            if 'SASL authentication' not in str(e):
+                raise
+            # only ask for new credentials once, for all threads
+            with self._kinit:
+                try:
+                    return nds2.connection(host, port)
+                except RuntimeError:
+                    from gwpy.io.nds import kinit
+                    kinit()
+                    return nds2.connection(host, port)
+
+    def _borrow(self, host, port):
+        """Take an idle connection from the pool, or open a new one
+
+        Returns
+        -------
+        conn : `nds2.connection`
+            the connection
+        reused : `bool`
+            `True` if the connection has been used before
+        """
+        with self._lock:
+            try:
+                return self._idle.get((host, port), []).pop(), True
+            except IndexError:
+                pass
+        return self._connect(host, port), False
+
+    def _release(self, host, port, conn):
+        with self._lock:
+            self._idle.setdefault((host, port), []).append(conn)
+
+    @staticmethod
+    def _discard(conn):
+        try:
+            conn.close()
+        except (AttributeError, RuntimeError):
+            pass
+
+    @contextmanager
+    def connection(self, host, port):
+        """Borrow a connection to the given server
+
+        If ``host`` is `None`, `None` is given, leaving the choice of
+        server to :meth:`~gwpy.timeseries.TimeSeriesDict.fetch`.
+        The connection is closed and discarded if an exception is raised.
+        """
+        if host is None:
+            yield None
+            return
+        conn = self._borrow(host, port)[0]
+        try:
+            yield conn
+        except:
+            self._discard(conn)
+            raise
+        self._release(host, port, conn)
+
+    def call(self, host, port, func):
+        """Call ``func(connection)`` with a borrowed connection
+
+        Idle connections may have been dropped by the server, so if a
+        re-used connection fails with a `RuntimeError`, the call is
+        retried once on a new connection.
+        """
+        if host is None:
+            return func(None)
+        conn, reused = self._borrow(host, port)
+        try:
+            out = func(conn)
+        except RuntimeError:
+            self._discard(conn)
+            if not reused:
+                raise
+            conn = self._connect(host, port)
+            try:
+                out = func(conn)
+            except:
+                self._discard(conn)
+                raise
+        except:
+            self._discard(conn)
+            raise
+        self._release(host, port, conn)
+        return out
+
+
+NDS_POOL = NDSConnectionPool()
+
+
+class AvailabilityCache(object):
+    """In-memory record of NDS2 channel data availability
+
+    For each (host, port, channel) key, the segments for which the server
+    has been asked are recorded along with the segments it reported as
+    available, so each span is only asked about once per job.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._known = {}
+
+    def get(self, channels, segments, host, port):
+        """Find the segments for which all channels are available
+
+        Parameters
+        ----------
+        channels : `list` of `~gwpy.detector.Channel`
+            the channels of interest
+        segments : `~gwpy.segments.SegmentList`
+            the segments of interest
+        host : `str`
+            the NDS2 server host
+        port : `int`
+            the NDS2 server port
+
+        Returns
+        -------
+        available : `~gwpy.segments.SegmentList`, `None`
+            the segments for which all channels are available, or `None`
+            if the server (or client library) doesn't report availability
+        """
+        if host is None or not abs(segments):
+            return None
+        span = segments.extent()
+        names = [c.ndsname for c in channels]
+        with self._lock:
+            ask = [n for n in names if
+                   SegmentList([span]) - self._known.get(
+                       (host, port, n), (SegmentList(), None))[0]]
+        if ask:
+            queried = SegmentList([span])
+            try:
+                with NDS_POOL.connection(host, port) as conn:
+                    if not hasattr(conn, 'get_availability'):
+                        return None
+                    conn.set_epoch(int(span[0]), int(span[1]) + 1)
+                    try:
+                        result = conn.get_availability(ask)
+                    finally:
+                        conn.set_epoch('ALL')
+            except RuntimeError:  # server can't tell us, so just ask
+                return None
+            with self._lock:
+                for name, avail in zip(ask, result):
+                    new = SegmentList(Segment(s.gps_start, s.gps_stop) for
+                                      s in avail.simple_list())
+                    known, have = self._known.get(
+                        (host, port, name), (SegmentList(), SegmentList()))
+                    self._known[(host, port, name)] = (
+                        (known | queried).coalesce(),
+                        (have | new).coalesce())
+        out = SegmentList(segments)
+        with self._lock:
+            for name in names:
+                out &= self._known[(host, port, name)][1]
+        return out
+
+
+NDS_AVAILABILITY = AvailabilityCache()
+
+
+def get_availability(channels, segments, host=None, port=None):
+    """Find the segments for which all channels are available from NDS2
+
+    See :meth:`AvailabilityCache.get` for details.
+    """
+    return NDS_AVAILABILITY.get(channels, segments, host, port)
+
+
+def iter_fetch(channels, segments, host=None, port=None, type=None,
+               DictClass=TimeSeriesDict, nthreads=4, nchannels=None,
+               **ioargs):
+    """Fetch data for a list of segments in parallel from NDS2
+
+    Up to ``nthreads`` segments are fetched at once, each over its own
+    connection, and large channel lists are split into groups of at most
+    ``nchannels`` channels per request.
+
+    Parameters
+    ----------
+    channels : `list` of `~gwpy.detector.Channel`
+        the channels to fetch
+    segments : `list` of `~gwpy.segments.Segment`
+        the ``[start, end)`` GPS segments to fetch
+    host : `str`, optional
+        the NDS2 server host, default: chosen by GWpy
+    port : `int`, optional
+        the NDS2 server port
+    type : `int`, optional
+        the NDS2 channel type
+    DictClass : `type`, optional
+        the dict class whose ``fetch`` method to call
+    nthreads : `int`, optional, default: 4
+        the maximum number of concurrent requests
+    nchannels : `int`, optional
+        the maximum number of channels per request, default: no limit
+    **ioargs
+        other keyword arguments to pass to ``DictClass.fetch``
+
+    Returns
+    -------
+    iterator
+        an iterator yielding one ``DictClass`` for each segment, in
+        order, so that at most ``nthreads`` segments of data are held in
+        memory at a time
+    """
+    channels = list(channels)
+    if nchannels:
+        groups = [channels[i:i+nchannels] for
+                  i in range(0, len(channels), nchannels)]
+    else:
+        groups = [channels]
+
+    def _fetch(args):
+        segment, group = args
+        return NDS_POOL.call(host, port, lambda conn: DictClass.fetch(
+            group, segment[0], segment[1], connection=conn, type=type,
+            **ioargs))
+
+    segments = list(segments)
+    if nthreads <= 1 or len(segments) * len(groups) == 1:
+        for segment in segments:
+            out = DictClass()
+            for group in groups:
+                out.update(_fetch((segment, group)))
+            yield out
+        return
+
+    pool = ThreadPool(nthreads)
+    try:
+        for i in range(0, len(segments), nthreads):
+            batch = segments[i:i+nthreads]
+            tasks = [(seg, group) for seg in batch for group in groups]
+            results = pool.map(_fetch, tasks)
+            for j in range(len(batch)):
+                out = DictClass()
+                for tsd in results[j*len(groups):(j+1)*len(groups)]:
+                    out.update(tsd)
+                yield out
+    finally:
+        pool.close()
@@ -24,17 +24,22 @@ from __future__ import division
 import hashlib
 import warnings
 from itertools import (izip, cycle)
+from math import ceil
 
 try:
     from collections import OrderedDict
 except ImportError:
     from ordereddict import OrderedDict
 
+import numpy
+
+from matplotlib import rcParams
 from matplotlib.pyplot import subplots
 
 from dateutil.relativedelta import relativedelta
 
 from gwpy.spectrum import Spectrum
+from gwpy.timeseries import TimeSeries
 from gwpy.plotter import *
 from gwpy.plotter.table import get_column_string
 from gwpy.plotter.tex import label_to_latex
@@ -46,7 +51,7 @@ from gwpy.time import (from_gps, to_gps)
 from .. import (globalv, mode, version)
 from ..utils import (re_quote, re_cchar, split_channels)
 from ..data import (get_channel, get_timeseries, get_spectrogram, get_spectrum,
-                    add_timeseries)
+                    get_decimated_spectrogram, add_timeseries)
 from ..segments import get_segments
 from ..triggers import get_triggers
 from ..state import ALLSTATE
@@ -59,6 +64,56 @@ DataPlot = get_plot('data')
 GREEN = (0.2, 0.8, 0.2)
 
 
+def decimate_timeseries(timeseries, npixels, method='envelope'):
+    """Reduce a `TimeSeries` to two samples per pixel column
+
+    Parameters
+    ----------
+    timeseries : `~gwpy.timeseries.TimeSeries`
+        the input data
+    npixels : `int`
+        the number of pixel columns covered by the data
+    method : `str`, optional, default: ``'envelope'``
+        ``'envelope'`` keeps the minimum and maximum of each column, in
+        time order, so that a line plot looks the same as at full
+        resolution, ``'min'`` or ``'max'`` keep only the column minimum
+        or maximum, on the same time grid
+
+    Returns
+    -------
+    decimated : `~gwpy.timeseries.TimeSeries`
+        the decimated series, or the input if it is already short enough
+    """
+    size = timeseries.size
+    width = int(ceil(size / max(npixels, 1)))
+    if width <= 2:
+        return timeseries
+    ncols = int(ceil(size / width))
+    data = numpy.empty(ncols * width, dtype=float)
+    data[:size] = numpy.asarray(timeseries)
+    data[size:] = numpy.nan
+    data = data.reshape((ncols, width))
+    nans = numpy.isnan(data)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        low = numpy.nanmin(data, axis=1)
+        high = numpy.nanmax(data, axis=1)
+    out = numpy.empty((ncols, 2))
+    if method == 'min':
+        out[:] = low[:, None]
+    elif method == 'max':
+        out[:] = high[:, None]
+    else:
+        rising = (numpy.where(nans, numpy.inf, data).argmin(axis=1) <=
+                  numpy.where(nans, -numpy.inf, data).argmax(axis=1))
+        out[:, 0] = numpy.where(rising, low, high)
+        out[:, 1] = numpy.where(rising, high, low)
+    return TimeSeries(out.ravel(), epoch=float(timeseries.span[0]),
+                      sample_rate=2 / (timeseries.dx.value * width),
+                      unit=timeseries.unit, name=timeseries.name,
+                      channel=timeseries.channel)
+
+
 class TimeSeriesDataPlot(DataPlot):
     """DataPlot of some `TimeSeries` data.
     """
@@ -106,6 +161,16 @@ class TimeSeriesDataPlot(DataPlot):
             ax.set_epoch(float(self.start))
         return self.plot, axes
 
+    def pixel_width(self, ax):
+        """Return the approximate width (in pixels) of the given `Axes`
+        in the saved figure
+        """
+        dpi = rcParams['savefig.dpi']
+        if not isinstance(dpi, (int, float)):
+            dpi = self.plot.dpi
+        return max(1, int(self.plot.get_figwidth() * dpi *
+                          ax.get_position().width))
+
     def finalize(self, outputfile=None):
         plot = self.plot
         ax = plot.axes[0]
@@ -122,6 +187,7 @@ class TimeSeriesDataPlot(DataPlot):
 
         plotargs = self.parse_plot_kwargs()
         legendargs = self.parse_legend_kwargs()
+        decimate = self.pargs.pop('decimate', True)
 
         # add data
         mmmchans = self.get_channel_groups()
@@ -142,6 +208,16 @@ class TimeSeriesDataPlot(DataPlot):
             for ts in data:
                 if not 'x0' in ts.metadata:
                     ts.epoch = self.start
+            # reduce to two samples per pixel column
+            if decimate:
+                npix = self.pixel_width(ax)
+                for i, (c, ts) in enumerate(zip(channels, data)):
+                    method = c.name.split('.')[-1]
+                    if method not in ['min', 'max']:
+                        method = 'envelope'
+                    data[i] = decimate_timeseries(
+                        ts, npix * float(abs(ts.span)) / float(abs(self.span)),
+                        method=method)
             # double-check log scales
             if self.pargs['logy']:
                 for ts in data:
@@ -237,18 +313,22 @@ class SpectrogramDataPlot(TimeSeriesDataPlot):
             valid = self.state.active
         else:
             valid = SegmentList([self.span])
-        specgrams = get_spectrogram(channel, valid, query=False,
-                                    format=sdform)
+        # only draw as many strides as the axes have pixels
+        specgrams = get_decimated_spectrogram(
+            channel, valid, abs(self.span) / self.pixel_width(ax),
+            format=sdform)
         # calculate ratio spectrum
         if ratio in ['median', 'mean'] or isinstance(ratio, int):
+            allspecs = get_spectrogram(channel, valid, query=False,
+                                       format=sdform)
             try:
-                allspec = specgrams.join(gap='ignore')
+                allspec = allspecs.join(gap='ignore')
             except ValueError as e:
                 if 'units do not match' in str(e):
                     warnings.warn(str(e))
-                    for spec in specgrams[1:]:
-                        spec.unit = specgrams[0].unit
-                    allspec = specgrams.join(gap='ignore')
+                    for spec in allspecs[1:]:
+                        spec.unit = allspecs[0].unit
+                    allspec = allspecs.join(gap='ignore')
                 else:
                     raise
             if isinstance(ratio, int):
@@ -1002,6 +1082,7 @@ class TriggerTimeSeriesDataPlot(TimeSeriesDataPlot):
         if isinstance(labels, (unicode, str)):
             labels = labels.split(',')
         labels = map(lambda s: str(s).strip('\n '), labels)
+        decimate = self.pargs.pop('decimate', True)
 
         # add data
         for label, channel in zip(labels, self.channels):
@@ -1018,6 +1099,11 @@ class TriggerTimeSeriesDataPlot(TimeSeriesDataPlot):
             # plot time-series
             color = None
             for ts in data:
+                # reduce to two samples per pixel column
+                if decimate:
+                    ts = decimate_timeseries(
+                        ts, self.pixel_width(ax) * float(abs(ts.span)) /
+                        float(abs(self.span)))
                 # double-check log scales
                 if self.pargs['logy']:
                     ts[ts.data == 0] = 1e-100
@@ -0,0 +1,618 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Duncan Macleod (2013)
+#
+# This file is part of GWSumm.
+#
+# GWSumm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GWSumm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GWSumm.  If not, see <http://www.gnu.org/licenses/>.
+
+"""In-process spectrogram engine with cached FFT plans
+
+The FFT segments for a whole `TimeSeries` are transformed in batches
+from a strided view of the data, rather than one stride at a time.
+If `pyfftw` is available, FFT plans are created once for each input shape
+and re-used for the rest of the job, and the FFTW wisdom accumulated
+while planning can be stored on disk, so that subsequent jobs don't need
+to plan again. Otherwise, `numpy.fft` is used.
+"""
+
+import cPickle
+import os
+import threading
+import time
+import warnings
+from math import log
+
+import numpy
+from numpy.lib.stride_tricks import as_strided
+
+try:
+    import pyfftw
+except ImportError:
+    pyfftw = None
+
+from scipy.signal import get_window
+
+from astropy import units
+
+from gwpy.segments import (Segment, SegmentList)
+from gwpy.spectrum import Spectrum
+from gwpy.spectrogram import Spectrogram
+
+from . import version
+
+__author__ = 'Duncan Macleod <duncan.macleod@ligo.org>'
+__version__ = version.version
+
+# FFTW planning effort for each LAL FFT plan level, wisdom is kept
+# between jobs, so the cost of measuring is only paid once
+PLANNER_EFFORT = {
+    1: 'FFTW_MEASURE',
+    2: 'FFTW_MEASURE',
+    3: 'FFTW_PATIENT',
+}
+FFT_PLAN_LEVEL = 1
+
+# maximum size (bytes) of windowed data transformed in one batch
+BLOCK_SIZE = 64 * 1024 ** 2
+
+_PLANS = {}
+_PLAN_LOCK = threading.Lock()
+_CHECKED = {}
+
+
+# -----------------------------------------------------------------------------
+# FFT plans
+
+def rfft(data):
+    """Compute the one-dimensional real FFT along the last axis of an array
+
+    When `pyfftw` is available, the plan for each input shape is created
+    once and cached.
+
+    Parameters
+    ----------
+    data : `numpy.ndarray`
+        the input data, the FFT is computed over the last axis
+
+    Returns
+    -------
+    fft : `numpy.ndarray`
+        the complex FFT of the input
+    """
+    if pyfftw is None:
+        return numpy.fft.rfft(data, axis=-1)
+    key = (data.shape, data.dtype.str)
+    with _PLAN_LOCK:
+        try:
+            plan = _PLANS[key]
+        except KeyError:
+            plan = _PLANS[key] = pyfftw.builders.rfft(
+                pyfftw.empty_aligned(data.shape, dtype=data.dtype),
+                planner_effort=PLANNER_EFFORT.get(FFT_PLAN_LEVEL,
+                                                  'FFTW_MEASURE'))
+        # the plan re-uses its output array, so return a copy
+        return plan(data).copy()
+
+
+def load_wisdom(path):
+    """Load FFTW wisdom from the given file, if possible
+
+    Returns
+    -------
+    loaded : `bool`
+        `True` if wisdom was loaded, otherwise `False`
+    """
+    if pyfftw is None or not os.path.isfile(path):
+        return False
+    try:
+        with open(path, 'rb') as f:
+            pyfftw.import_wisdom(cPickle.load(f))
+    except (IOError, EOFError, cPickle.UnpicklingError):
+        return False
+    return True
+
+
+def save_wisdom(path):
+    """Write the current FFTW wisdom to the given file, if possible
+    """
+    if pyfftw is None:
+        return
+    dirname = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    with open(path, 'wb') as f:
+        cPickle.dump(pyfftw.export_wisdom(), f, cPickle.HIGHEST_PROTOCOL)
+
+
+# -----------------------------------------------------------------------------
+# spectrograms
+
+def median_bias(n):
+    """Return the bias factor of the median of ``n`` exponential variates
+
+    This is the same correction as is applied by ``XLALMedianBias``.
+    """
+    if n >= 1000:
+        return log(2)
+    ans = 1.
+    for i in range(1, (n - 1) // 2 + 1):
+        ans -= 1. / (2 * i)
+        ans += 1. / (2 * i + 1)
+    return ans
+
+
+def average_spectra(power, method='median-mean', axis=-2):
+    """Average a set of power spectra
+
+    Parameters
+    ----------
+    power : `numpy.ndarray`
+        array of one-sided power spectra
+    method : `str`, optional, default: ``'median-mean'``
+        averaging method, one of ``'mean'``, ``'median'`` or
+        ``'median-mean'``
+    axis : `int`, optional, default: -2
+        the axis of ``power`` over which to average
+
+    Returns
+    -------
+    average : `numpy.ndarray`
+        the averaged spectra
+    """
+    method = method.lower().replace('-', '').replace('_', '')
+    n = power.shape[axis]
+    if method in ['mean', 'welch'] or n == 1:
+        return power.mean(axis=axis)
+    elif method == 'median':
+        return numpy.median(power, axis=axis) / median_bias(n)
+    elif method == 'medianmean':
+        axis %= power.ndim
+        even = power[(slice(None),) * axis + (slice(0, None, 2),)]
+        odd = power[(slice(None),) * axis + (slice(1, None, 2),)]
+        return (numpy.median(even, axis=axis) / median_bias(even.shape[axis]) +
+                numpy.median(odd, axis=axis) / median_bias(odd.shape[axis])
+                ) / 2.
+    raise ValueError("Cannot average spectra with method %r" % method)
+
+
+def spectrogram(timeseries, stride, fftlength, overlap=0,
+                method='median-mean', window='hann', blocksize=BLOCK_SIZE):
+    """Calculate the average power spectrogram of a `TimeSeries`
+
+    All FFT segments are taken from a strided view of the input data, of
+    shape ``(nstrides, nffts, fftlength)``, which is windowed (as float64)
+    and transformed in blocks of strides with a single (cached) FFT plan,
+    and averaged along the FFT axis for all strides in the block at once.
+    The input is only copied if it isn't contiguous in memory.
+
+    Parameters
+    ----------
+    timeseries : `~gwpy.timeseries.TimeSeries`
+        the input data
+    stride : `float`
+        the duration (seconds) of each spectrogram stride
+    fftlength : `float`
+        the duration (seconds) of each FFT
+    overlap : `float`, optional, default: 0
+        the overlap (seconds) between consecutive FFTs
+    method : `str`, optional, default: ``'median-mean'``
+        averaging method, see :func:`average_spectra`
+    window : `str`, optional, default: ``'hann'``
+        the name of the window to apply to each FFT segment
+    blocksize : `int`, optional
+        the maximum size (bytes) of windowed float64 data to transform at
+        once, limiting the working memory of the engine
+
+    Returns
+    -------
+    spectrogram : `~gwpy.spectrogram.Spectrogram`
+        the one-sided power spectral density for each whole stride in the
+        input, any data after the last whole stride are ignored
+    """
+    rate = timeseries.sample_rate.value
+    nfft = int(round(fftlength * rate))
+    nstep = nfft - int(round(overlap * rate))
+    nstride = int(round(stride * rate))
+    if nfft > nstride:
+        raise ValueError("FFT length cannot be longer than stride")
+    nsteps = 1 + (nstride - nfft) // nstep
+    nstrides = timeseries.size // nstride
+    win = get_window(window, nfft)
+    scale = 2 / (rate * (win ** 2).sum())
+
+    data = numpy.ascontiguousarray(timeseries)
+    size = data.itemsize
+    segments = as_strided(data, shape=(nstrides, nsteps, nfft),
+                          strides=(nstride * size, nstep * size, size))
+    nblock = max(1, blocksize // (nsteps * nfft * 8))
+    out = numpy.empty((nstrides, nfft // 2 + 1))
+    for i in range(0, nstrides, nblock):
+        # the window is float64, so this casts only the current block
+        fft = rfft(segments[i:i+nblock] * win)
+        power = numpy.multiply(fft.real, fft.real)
+        power += fft.imag ** 2
+        power *= scale
+        power[..., 0] /= 2.
+        if not nfft % 2:
+            power[..., -1] /= 2.
+        out[i:i+nblock] = average_spectra(power, method=method, axis=-2)
+
+    unit = timeseries.unit or units.dimensionless_unscaled
+    return Spectrogram(out, epoch=float(timeseries.span[0]), dt=stride, f0=0,
+                       df=1. / fftlength, unit=unit ** 2 / units.Hertz,
+                       name=timeseries.name, channel=timeseries.channel)
+
+
+def compare_spectrogram(timeseries, stride, fftlength, overlap=0,
+                        method='median-mean', window='hann', nstrides=4):
+    """Compare :func:`spectrogram` with `TimeSeries.spectrogram`
+
+    The first ``nstrides`` strides of the input are computed by both
+    engines, and the outputs and run times compared.
+
+    Returns
+    -------
+    deviation : `float`
+        the largest fractional difference between the two spectrograms,
+        over all bins in which `gwpy` gives non-zero power
+    times : `tuple` of `float`
+        the time (seconds) taken by this engine, and by `gwpy`
+    """
+    start = float(timeseries.span[0])
+    end = min(float(timeseries.span[1]), start + nstrides * stride)
+    ts = timeseries.crop(start, end)
+    t0 = time.time()
+    ours = numpy.asarray(spectrogram(ts, stride, fftlength, overlap=overlap,
+                                     method=method, window=window))
+    t1 = time.time()
+    theirs = numpy.asarray(ts.spectrogram(stride, fftlength=fftlength,
+                                          overlap=overlap, method=method,
+                                          window=window))
+    t2 = time.time()
+    n = min(ours.shape[0], theirs.shape[0])
+    if ours.shape[1] != theirs.shape[1]:
+        raise ValueError("Spectrograms have different frequencies")
+    ours, theirs = ours[:n], theirs[:n]
+    good = theirs > 0
+    if not good.any():
+        deviation = 0.
+    else:
+        deviation = float((abs(ours[good] - theirs[good]) /
+                           theirs[good]).max())
+    return deviation, (t1 - t0, t2 - t1)
+
+
+def check_spectrogram(timeseries, stride, fftlength, overlap=0,
+                      method='median-mean', window='hann', rtol=1e-3):
+    """Check once that :func:`spectrogram` agrees with `gwpy` for the
+    given parameters
+
+    The comparison is made on the first strides of the first input seen
+    for each set of parameters (see :func:`compare_spectrogram`), and the
+    result is cached for the rest of the job.
+
+    Returns
+    -------
+    agrees : `bool`
+        `True` if the largest fractional difference is within ``rtol``
+    """
+    key = (timeseries.sample_rate.value, stride, fftlength, overlap,
+           method, window)
+    with _PLAN_LOCK:
+        try:
+            return _CHECKED[key]
+        except KeyError:
+            pass
+    try:
+        deviation, times = compare_spectrogram(
+            timeseries, stride, fftlength, overlap=overlap, method=method,
+            window=window)
+    except ValueError as e:
+        warnings.warn("Cannot check spectrogram engine: %s" % str(e))
+        agrees = False
+    else:
+        agrees = deviation <= rtol
+        if not agrees:
+            warnings.warn("Spectrogram engine differs from gwpy by up to "
+                          "%.2g for %s" % (deviation, str(key)))
+    with _PLAN_LOCK:
+        _CHECKED[key] = agrees
+    return agrees
+
+
+# -----------------------------------------------------------------------------
+# percentiles
+
+def percentile_spectra(speclist, percentiles, blocksize=BLOCK_SIZE):
+    """Calculate a number of percentile spectra over a list of spectrograms
+
+    The spectrograms are not joined, instead each block of frequency
+    bins is gathered from every spectrogram in turn, and partitioned once
+    for all requested percentiles, using the same linear interpolation
+    as :func:`numpy.percentile`.
+
+    Parameters
+    ----------
+    speclist : `~gwpy.spectrogram.SpectrogramList`
+        the list of spectrograms, all with the same frequencies
+    percentiles : `list` of `float`
+        the percentiles (0-100) to calculate
+    blocksize : `int`, optional
+        the maximum size (bytes) of data gathered at once
+
+    Returns
+    -------
+    spectra : `list` of `~gwpy.spectrum.Spectrum`
+        one spectrum for each of the given percentiles, in order
+
+    Raises
+    ------
+    ValueError
+        if the list is empty, or the spectrograms have different numbers
+        of frequency bins
+    """
+    if not len(speclist):
+        raise ValueError("Cannot calculate percentiles of empty list")
+    first = speclist[0]
+    nfreq = first.shape[1]
+    if any(s.shape[1] != nfreq for s in speclist):
+        raise ValueError("Cannot calculate percentiles of spectrograms with "
+                         "different frequencies")
+    ntimes = sum(s.shape[0] for s in speclist)
+
+    # rank of each percentile in the sorted data
+    ranks = [q / 100. * (ntimes - 1) for q in percentiles]
+    lower = [int(r) for r in ranks]
+    upper = [min(l + 1, ntimes - 1) for l in lower]
+    kth = sorted(set(lower + upper))
+
+    out = numpy.empty((len(percentiles), nfreq))
+    nblock = max(1, blocksize // (ntimes * 8))
+    buffer_ = numpy.empty((ntimes, min(nblock, nfreq)))
+    for f in range(0, nfreq, nblock):
+        width = min(nblock, nfreq - f)
+        block = buffer_[:, :width]
+        i = 0
+        for spec in speclist:
+            n = spec.shape[0]
+            block[i:i+n] = numpy.asarray(spec)[:, f:f+width]
+            i += n
+        block.partition(kth, axis=0)
+        for j, (rank, lo, hi) in enumerate(zip(ranks, lower, upper)):
+            out[j, f:f+width] = block[lo]
+            if hi != lo:
+                out[j, f:f+width] += (block[hi] - block[lo]) * (rank - lo)
+
+    return [Spectrum(data, f0=first.f0, df=first.df, unit=first.unit,
+                     channel=first.channel,
+                     name='%s %s%% percentile' % (first.name, q))
+            for data, q in zip(out, percentiles)]
+
+
+# -----------------------------------------------------------------------------
+# sketches
+
+class SpectrumSketch(object):
+    """Mergeable histogram of spectral power for each frequency bin
+
+    Each power value is counted in a log-spaced bin, with
+    `BINS_PER_DECADE` bins per decade anchored at integer powers of ten,
+    so sketches from different jobs (e.g. daily archives) can be merged
+    exactly by adding their counts, and percentile spectra recovered to
+    within the bin width, without holding the spectrograms in memory.
+
+    Parameters
+    ----------
+    f0 : `float`, optional, default: 0
+        the frequency (Hz) of the first bin
+    df : `float`, optional, default: 1
+        the frequency resolution (Hz)
+    unit : `~astropy.units.Unit`, optional
+        the unit of the spectral power
+    name : `str`, optional
+        the name of these data
+    channel : `~gwpy.detector.Channel`, `str`, optional
+        the source channel of these data
+
+    Attributes
+    ----------
+    counts : `numpy.ndarray`
+        the ``(nfreq, nbins)`` histogram counts, or `None` if empty
+    offset : `int`
+        the index of the first power bin, power bin ``i`` covers
+        ``[10 ** (i / BINS_PER_DECADE), 10 ** ((i + 1) / BINS_PER_DECADE))``
+    segments : `~gwpy.segments.SegmentList`
+        the GPS segments of data counted in this sketch
+    """
+    BINS_PER_DECADE = 20
+
+    def __init__(self, f0=0, df=1, unit=None, name=None, channel=None):
+        self.f0 = f0
+        self.df = df
+        self.unit = unit
+        self.name = name
+        self.channel = channel
+        self.offset = 0
+        self.counts = None
+        self.segments = SegmentList()
+
+    def _extend(self, first, last, nfreq):
+        """Grow the histogram to include power bins ``first`` to ``last``
+        """
+        if self.counts is None:
+            self.offset = first
+            self.counts = numpy.zeros((nfreq, last - first + 1),
+                                      dtype=numpy.int64)
+            return
+        if self.counts.shape[0] != nfreq:
+            raise ValueError("Cannot add data with %d frequency bins to "
+                             "sketch with %d" % (nfreq, self.counts.shape[0]))
+        nbins = self.counts.shape[1]
+        start = min(first, self.offset)
+        end = max(last, self.offset + nbins - 1)
+        if start == self.offset and end == self.offset + nbins - 1:
+            return
+        counts = numpy.zeros((nfreq, end - start + 1), dtype=numpy.int64)
+        counts[:, self.offset - start:self.offset - start + nbins] = (
+            self.counts)
+        self.counts = counts
+        self.offset = start
+
+    def update(self, specgram):
+        """Count the power in each stride of a `Spectrogram`
+
+        Non-positive and non-finite values are ignored.
+        """
+        if self.counts is None:
+            self.f0 = float(getattr(specgram.f0, 'value', specgram.f0))
+            self.df = float(getattr(specgram.df, 'value', specgram.df))
+            self.unit = specgram.unit
+            self.name = specgram.name
+            self.channel = specgram.channel
+        values = numpy.asarray(specgram, dtype=float)
+        nfreq = values.shape[1]
+        good = numpy.isfinite(values) & (values > 0)
+        fidx = numpy.nonzero(good)[1]
+        pidx = numpy.floor(numpy.log10(values[good]) *
+                           self.BINS_PER_DECADE).astype(int)
+        if pidx.size:
+            self._extend(pidx.min(), pidx.max(), nfreq)
+            nbins = self.counts.shape[1]
+            self.counts += numpy.bincount(
+                fidx * nbins + (pidx - self.offset),
+                minlength=self.counts.size).reshape(self.counts.shape)
+        self.segments = (self.segments |
+                         SegmentList([Segment(*specgram.span)])).coalesce()
+
+    def merge(self, other):
+        """Add the counts from another sketch to this one
+
+        Raises
+        ------
+        ValueError
+            if the two sketches have different frequency bins, or count
+            overlapping data
+        """
+        if abs(self.segments & other.segments):
+            raise ValueError("Cannot merge sketches of overlapping data")
+        if other.counts is not None:
+            if self.counts is None:
+                self.f0, self.df = other.f0, other.df
+                self.unit = other.unit
+                self.name = other.name
+                self.channel = other.channel
+            elif (self.f0, self.df) != (other.f0, other.df):
+                raise ValueError("Cannot merge sketches with different "
+                                 "frequencies")
+            nfreq, nbins = other.counts.shape
+            self._extend(other.offset, other.offset + nbins - 1, nfreq)
+            start = other.offset - self.offset
+            self.counts[:, start:start + nbins] += other.counts
+        self.segments = (self.segments | other.segments).coalesce()
+        return self
+
+    def percentiles(self, percentiles):
+        """Estimate a number of percentile spectra
+
+        Each value is the geometric centre of the power bin containing
+        the given percentile.
+
+        Returns
+        -------
+        spectra : `list` of `~gwpy.spectrum.Spectrum`
+            one spectrum for each of the given percentiles, in order
+
+        Raises
+        ------
+        ValueError
+            if this sketch is empty
+        """
+        if self.counts is None:
+            raise ValueError("Cannot calculate percentiles of empty sketch")
+        cumulative = self.counts.cumsum(axis=1)
+        total = cumulative[:, -1]
+        centres = 10 ** ((numpy.arange(self.counts.shape[1]) + self.offset +
+                          .5) / self.BINS_PER_DECADE)
+        out = []
+        for q in percentiles:
+            rank = q / 100. * (total - 1)
+            idx = (cumulative <= rank[:, None]).sum(axis=1)
+            data = centres[numpy.minimum(idx, centres.size - 1)]
+            data[total == 0] = numpy.nan
+            out.append(Spectrum(data, f0=self.f0, df=self.df, unit=self.unit,
+                                channel=self.channel,
+                                name='%s %s%% percentile' % (self.name, q)))
+        return out
+
+    def write(self, group, name):
+        """Write this sketch as a dataset in the given HDF5 group
+        """
+        dset = group.create_dataset(name, data=(
+            self.counts if self.counts is not None else
+            numpy.zeros((0, 0), dtype=numpy.int64)))
+        dset.attrs['offset'] = self.offset
+        dset.attrs['f0'] = self.f0
+        dset.attrs['df'] = self.df
+        dset.attrs['unit'] = str(self.unit) if self.unit is not None else ''
+        dset.attrs['name'] = str(self.name)
+        dset.attrs['channel'] = str(self.channel)
+        dset.attrs['segments'] = numpy.array(
+            [(float(s[0]), float(s[1])) for s in self.segments],
+            dtype=float).reshape((len(self.segments), 2))
+        return dset
+
+    @classmethod
+    def read(cls, dataset):
+        """Read a sketch from an HDF5 dataset written by :meth:`write`
+        """
+        attrs = dataset.attrs
+        new = cls(f0=float(attrs['f0']), df=float(attrs['df']),
+                  unit=units.Unit(attrs['unit']) if attrs['unit'] else None,
+                  name=attrs['name'], channel=attrs['channel'])
+        counts = dataset[()]
+        if counts.size:
+            new.counts = counts.astype(numpy.int64)
+            new.offset = int(attrs['offset'])
+        new.segments = SegmentList(Segment(*s) for s in attrs['segments'])
+        return new
+
+
+# -----------------------------------------------------------------------------
+# time decimation
+
+def decimate_spectrogram(specgram, factor):
+    """Average each block of ``factor`` strides of a `Spectrogram`
+
+    Parameters
+    ----------
+    specgram : `~gwpy.spectrogram.Spectrogram`
+        the input spectrogram
+    factor : `int`
+        the number of strides to average into each output stride
+
+    Returns
+    -------
+    decimated : `~gwpy.spectrogram.Spectrogram`, `None`
+        the decimated spectrogram, covering only whole blocks of input
+        strides, or `None` if the input doesn't have enough strides
+    """
+    nblocks = specgram.shape[0] // factor
+    if not nblocks:
+        return None
+    data = numpy.asarray(specgram)[:nblocks * factor]
+    out = data.reshape((nblocks, factor, data.shape[1])).mean(axis=1)
+    return Spectrogram(out, epoch=float(specgram.span[0]),
+                       dt=specgram.dt.value * factor, f0=specgram.f0,
+                       df=specgram.df, unit=specgram.unit,
+                       name=specgram.name, channel=specgram.channel)
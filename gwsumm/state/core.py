@@ -161,6 +161,20 @@ class SummaryState(DataQualityFlag):
         else:
             self._definition = None
 
+    @property
+    def channel(self):
+        """The name of the channel thresholded to define this
+        `SummaryState`, or `None` if it is defined by segments.
+
+        :type: `str`
+        """
+        if not self.definition:
+            return None
+        match = re.search('(%s)' % '|'.join(MATHOPS.keys()), self.definition)
+        if match:
+            return self.definition.split(match.groups()[0])[0].rstrip()
+        return None
+
     @property
     def key(self):
         """The registry key for this `SummaryState`.
@@ -0,0 +1,499 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Duncan Macleod (2013)
+#
+# This file is part of GWSumm.
+#
+# GWSumm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GWSumm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GWSumm.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Memory-managed storage for the global data containers
+
+This module is imported by :mod:`gwsumm.globalv`, so must not import
+anything from GWSumm that itself requires the global memory.
+"""
+
+import atexit
+import bisect
+import itertools
+import os
+import re
+import tempfile
+import threading
+from functools import wraps
+
+import numpy
+
+from gwpy.segments import (Segment, SegmentList)
+
+from . import version
+
+__author__ = 'Duncan Macleod <duncan.macleod@ligo.org>'
+__version__ = version.version
+
+
+class MemoryBudget(object):
+    """Memory limit shared between a number of `DataStore` objects
+
+    When the total resident size of all registered stores exceeds the
+    ``limit``, the least-recently used keys are spilled to disk as
+    memory-mapped files until the total is back under the limit.
+
+    Parameters
+    ----------
+    limit : `int`, optional
+        maximum number of bytes to hold in memory, default: no limit
+    spilldir : `str`, optional
+        directory in which to write spilled data, default: the system
+        temporary directory
+    """
+    def __init__(self, limit=None, spilldir=None):
+        self.limit = limit
+        self.spilldir = spilldir
+        self.stores = []
+        self.clock = itertools.count()
+        self.lock = threading.RLock()
+        self._files = []
+
+    def register(self, store):
+        """Add a `DataStore` to this budget
+        """
+        self.stores.append(store)
+
+    def nbytes(self):
+        """Return the total resident size of all registered stores
+        """
+        return sum(store.nbytes() for store in self.stores)
+
+    def enforce(self, protect=None):
+        """Spill least-recently used data until under the limit
+
+        Parameters
+        ----------
+        protect : `tuple`, optional
+            ``(store, key)`` pair that should not be spilled, normally the
+            data that has just been added
+
+        Returns
+        -------
+        nbytes : `int`
+            the number of bytes spilled to disk
+        """
+        if self.limit is None:
+            return 0
+        with self.lock:
+            return self._enforce(protect=protect)
+
+    def _enforce(self, protect=None):
+        total = self.nbytes()
+        spilled = 0
+        if total <= self.limit:
+            return spilled
+        candidates = []
+        for i, store in enumerate(self.stores):
+            if not store.spill:
+                continue
+            for key in store.keys():
+                if protect and store is protect[0] and key == protect[1]:
+                    continue
+                if store.nbytes(key):
+                    candidates.append((store._access.get(key, -1), i, key))
+        candidates.sort()
+        for (_, i, key) in candidates:
+            nbytes = self.stores[i].spill_key(key)
+            spilled += nbytes
+            total -= nbytes
+            if total <= self.limit:
+                break
+        return spilled
+
+    def spill_array(self, key, array):
+        """Write an array to disk and return a memory-mapped copy
+        """
+        if self.spilldir and not os.path.isdir(self.spilldir):
+            os.makedirs(self.spilldir)
+        fd, path = tempfile.mkstemp(
+            prefix='gwsumm-%s-' % re.sub('[^\w.-]', '_', str(key)),
+            suffix='.npy', dir=self.spilldir)
+        with os.fdopen(fd, 'wb') as f:
+            numpy.save(f, numpy.asarray(array))
+        self._files.append(path)
+        mapped = numpy.load(path, mmap_mode='c').view(type(array))
+        mapped.__dict__.update(getattr(array, '__dict__', {}))
+        return mapped
+
+    def cleanup(self):
+        """Remove all spilled files from disk
+        """
+        while self._files:
+            try:
+                os.remove(self._files.pop())
+            except OSError:
+                pass
+
+
+def _locked(func):
+    """Decorate a `DataStore` method to hold the lock of its budget
+    """
+    @wraps(func)
+    def locked(self, *args, **kwargs):
+        with self.budget.lock:
+            return func(self, *args, **kwargs)
+    return locked
+
+
+class DataStore(dict):
+    """A `dict` of data lists with memory accounting
+
+    Each key is normally a `~gwpy.timeseries.TimeSeriesList` or
+    `~gwpy.spectrogram.SpectrogramList`, the time of the last access of
+    each key is recorded, so that the least-recently used data can be
+    spilled to disk when the shared `MemoryBudget` is exceeded.
+
+    Spilled data remain in the store as memory-mapped arrays, so are
+    transparently paged back in when next used.
+
+    New data should be added with :meth:`~DataStore.append`, which keeps
+    an up-to-date record of the segments covered by each key, and can
+    defer coalescing the data list until all new data have been added.
+
+    All methods that modify the store or its records hold the lock of
+    the `MemoryBudget`, so a store can be shared between threads.
+
+    Parameters
+    ----------
+    spill : `bool`, optional, default: `True`
+        allow data from this store to be spilled to disk, otherwise the
+        data are only counted
+    budget : `MemoryBudget`, optional
+        the budget to share, default: the global `BUDGET`
+    """
+    def __init__(self, *args, **kwargs):
+        self.spill = kwargs.pop('spill', True)
+        self.budget = kwargs.pop('budget', BUDGET)
+        super(DataStore, self).__init__(*args, **kwargs)
+        self._access = {}
+        self._segments = {}
+        self._version = {}
+        self._coverage = {}
+        self._index = {}
+        self._pending = set()
+        self.budget.register(self)
+
+    def _touch(self, key):
+        self._access[key] = next(self.budget.clock)
+
+    def __getitem__(self, key):
+        out = super(DataStore, self).__getitem__(key)
+        self._touch(key)
+        return out
+
+    def __setitem__(self, key, value):
+        super(DataStore, self).__setitem__(key, value)
+        self._forget(key)
+        self.invalidate(key)
+        self._touch(key)
+
+    def __delitem__(self, key):
+        super(DataStore, self).__delitem__(key)
+        self._forget(key)
+        self._access.pop(key, None)
+
+    @_locked
+    def _forget(self, key):
+        """Discard all cached records for the given key
+        """
+        self._segments.pop(key, None)
+        self._version.pop(key, None)
+        self._index.pop(key, None)
+        self._pending.discard(key)
+        for keys in [k for k in self._coverage if key in k]:
+            del self._coverage[keys]
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    @_locked
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        self._forget(key)
+        self._access.pop(key, None)
+        return super(DataStore, self).pop(key, *default)
+
+    @_locked
+    def invalidate(self, key):
+        """Discard the cached segments and index for the given key
+
+        This must be called after the data list for a key is modified
+        in place other than through :meth:`~DataStore.append` or
+        :meth:`~DataStore.coalesce`, e.g. when stored items are cropped
+        or replaced.
+        """
+        self._segments.pop(key, None)
+        self._index.pop(key, None)
+        self._version[key] = next(self.budget.clock)
+
+    @_locked
+    def append(self, key, data, coalesce=True):
+        """Append new data to the list for the given key
+
+        Parameters
+        ----------
+        key : `str`
+            the key to append to, this must already exist in the store
+        data : `~gwpy.data.Array`
+            the new data to append
+        coalesce : `bool`, optional, default: `True`
+            coalesce the data list immediately, otherwise the coalesce is
+            deferred until the next call to :meth:`~DataStore.coalesce`
+        """
+        segments = self.segments(key)
+        items = super(DataStore, self).__getitem__(key)
+        items.append(data)
+        self._index.pop(key, None)
+        _insert_segment(segments, data.span)
+        self._segments[key] = (id(items), len(items), segments)
+        self._version[key] = next(self.budget.clock)
+        self._pending.add(key)
+        self._touch(key)
+        if coalesce:
+            self.coalesce(key)
+
+    @_locked
+    def coalesce(self, *keys):
+        """Coalesce the data list for the given keys
+
+        If no keys are given, all keys with data appended since they were
+        last coalesced are processed.
+        """
+        if not keys:
+            keys = list(self._pending)
+        for key in keys:
+            self._pending.discard(key)
+            items = super(DataStore, self).get(key)
+            if items is None:
+                continue
+            segments = self.segments(key)
+            self._index.pop(key, None)
+            items.coalesce()
+            self._segments[key] = (id(items), len(items), segments)
+
+    @_locked
+    def segments(self, key):
+        """Return the segments covered by the data for the given key
+
+        The result is cached until the data list is replaced, or its
+        length changes, so any other in-place modification must be
+        followed by a call to :meth:`~DataStore.invalidate`.
+
+        Returns
+        -------
+        segments : `~gwpy.segments.SegmentList`
+            the coalesced list of segments covered by this key
+        """
+        items = super(DataStore, self).get(key)
+        if items is None:
+            return SegmentList()
+        try:
+            id_, n, segments = self._segments[key]
+        except KeyError:
+            pass
+        else:
+            if id_ == id(items) and n == len(items):
+                return segments
+        segments = SegmentList(item.span for item in items).coalesce()
+        self._segments[key] = (id(items), len(items), segments)
+        self._version[key] = next(self.budget.clock)
+        return segments
+
+    @_locked
+    def coverage(self, keys):
+        """Return the segments covered by the data for all of the given keys
+
+        The intersection is cached for each set of keys, and is only
+        recalculated when new data have been added for one of them.
+
+        Returns
+        -------
+        segments : `~gwpy.segments.SegmentList`
+            the list of segments for which all keys have data
+        """
+        keys = tuple(sorted(set(keys)))
+        if not keys:
+            return SegmentList()
+        segments = [self.segments(key) for key in keys]
+        versions = tuple(self._version.get(key) for key in keys)
+        try:
+            cached, out = self._coverage[keys]
+        except KeyError:
+            pass
+        else:
+            if cached == versions:
+                return out
+        out = segments[0]
+        for segs in segments[1:]:
+            out = out & segs
+        self._coverage[keys] = (versions, out)
+        return out
+
+    @_locked
+    def overlapping(self, key, segment):
+        """Return the stored data for this key that overlap a segment
+
+        A sorted index of the start and end times of each stored item is
+        searched with `bisect`, so only those items that actually overlap
+        the segment are visited.
+
+        Parameters
+        ----------
+        key : `str`
+            the key to search
+        segment : `~gwpy.segments.Segment`
+            the GPS ``[start, end)`` segment of interest
+
+        Returns
+        -------
+        data : `list`
+            the stored items whose span intersects the segment, in
+            time order
+        """
+        items = super(DataStore, self).get(key)
+        if not items:
+            return []
+        try:
+            id_, n, starts, maxends, order = self._index[key]
+        except KeyError:
+            id_ = n = None
+        if id_ != id(items) or n != len(items):
+            order = sorted(range(len(items)), key=lambda i: items[i].span[0])
+            starts = [items[i].span[0] for i in order]
+            maxends = []
+            for i in order:
+                end = items[i].span[1]
+                if maxends:
+                    end = max(maxends[-1], end)
+                maxends.append(end)
+            self._index[key] = (id(items), len(items), starts, maxends, order)
+        self._touch(key)
+        # items starting before the segment end, and ending after its start
+        hi = bisect.bisect_left(starts, segment[1])
+        lo = bisect.bisect_right(maxends, segment[0], 0, hi)
+        return [items[order[i]] for i in range(lo, hi) if
+                items[order[i]].span[1] > segment[0]]
+
+    def nbytes(self, key=None):
+        """Return the number of bytes held in memory
+
+        Parameters
+        ----------
+        key : `str`, optional
+            the key to count, default: all keys
+        """
+        if key is None:
+            return sum(self.nbytes(k) for k in self.keys())
+        value = super(DataStore, self).get(key, [])
+        # LIGO_LW tables are estimated, assuming 8 bytes per column
+        if hasattr(value, 'columnnames'):
+            return len(value) * len(value.columnnames) * 8
+        return sum(_resident_nbytes(item) for item in value)
+
+    def spilled_nbytes(self, key):
+        """Return the number of bytes spilled to disk for this key
+        """
+        value = super(DataStore, self).get(key, [])
+        if hasattr(value, 'columnnames'):
+            return 0
+        return sum(getattr(item, 'nbytes', 0) - _resident_nbytes(item) for
+                   item in value)
+
+    @_locked
+    def spill_key(self, key):
+        """Spill all in-memory arrays for this key to disk
+
+        Returns
+        -------
+        nbytes : `int`
+            the number of bytes moved from memory to disk
+        """
+        if not self.spill:
+            return 0
+        items = super(DataStore, self).__getitem__(key)
+        nbytes = 0
+        for i, item in enumerate(items):
+            n = _resident_nbytes(item)
+            if n:
+                items[i] = self.budget.spill_array(key, item)
+                nbytes += n
+        return nbytes
+
+    def enforce_budget(self, key):
+        """Mark this key as used, and apply the memory budget
+
+        This should be called after new data have been added to the store.
+        """
+        self._touch(key)
+        return self.budget.enforce(protect=(self, key))
+
+    def report(self):
+        """Summarise the size of each key in this store
+
+        Returns
+        -------
+        report : `list` of `tuple`
+            ``(key, resident bytes, spilled bytes)`` for each key,
+            largest first
+        """
+        return sorted(((key, self.nbytes(key), self.spilled_nbytes(key)) for
+                       key in self.keys()), key=lambda x: -x[1] - x[2])
+
+
+def _insert_segment(segments, segment):
+    """Insert a segment into a coalesced, sorted `SegmentList` in place
+    """
+    segment = Segment(*segment)
+    i = bisect.bisect_left(segments, segment)
+    # merge with any overlapping neighbours
+    if i and segments[i-1][1] >= segment[0]:
+        i -= 1
+    j = i
+    while j < len(segments) and segments[j][0] <= segment[1]:
+        segment = Segment(min(segment[0], segments[j][0]),
+                          max(segment[1], segments[j][1]))
+        j += 1
+    segments[i:j] = [segment]
+
+
+def _resident_nbytes(obj):
+    """Return the number of bytes of this object held in memory
+
+    Arrays backed by memory-mapped files are not counted, nor are objects
+    that don't report their size.
+    """
+    nbytes = getattr(obj, 'nbytes', None)
+    if nbytes is None:
+        return 0
+    base = obj
+    while base is not None:
+        if isinstance(base, numpy.memmap):
+            return 0
+        base = getattr(base, 'base', None)
+    return nbytes
+
+
+BUDGET = MemoryBudget()
+atexit.register(BUDGET.cleanup)
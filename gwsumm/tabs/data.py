@@ -43,9 +43,10 @@ from gwpy.segments import DataQualityFlag
 
 from .. import (version, globalv, html)
 from ..config import *
-from ..mode import (get_mode, MODE_ENUM)
+from ..mode import (get_mode, MODE_ENUM, SUMMARY_MODE_DAY)
 from ..data import (get_channel, get_timeseries_dict, get_spectrogram,
                     get_spectrum)
+from ..expression import parse_expression
 from ..plot import get_plot
 from ..segments import get_segments
 from ..state import (ALLSTATE, SummaryState, get_state)
@@ -314,6 +315,14 @@ class DataTab(DataTabBase):
                             subplot.span = span
                             job.subplots.append(subplot)
 
+        # spectrum plots need the full band of each spectrogram
+        for plot in job.plots:
+            if plot.data in ['spectrum', 'rayleigh-spectrum']:
+                for channel in plot.channels:
+                    globalv.FULL_BAND_SPECTRA.update(
+                        parse_expression(channel.ndsname).channels)
+                    globalv.FULL_BAND_SPECTRA.add(channel.ndsname)
+
         return job
 
     # -------------------------------------------
@@ -436,9 +445,21 @@ class DataTab(DataTabBase):
         # --------------------------------------------------------------------
         # process time-series
 
+        # long-span jobs merge the daily sketches of sketched spectra, so
+        # don't need the data for those channels
+        if get_mode() == SUMMARY_MODE_DAY:
+            spchannels = self.get_channels('spectrum', all_data=all_data,
+                                           read=True)
+        else:
+            spchannels = [c for c in self.get_channels(
+                'spectrum', all_data=all_data, read=True) if
+                          c.ndsname not in globalv.SKETCH_SPECTRA]
+
         # find channels that need a TimeSeries
-        tschannels = self.get_channels('timeseries', 'spectrogram', 'spectrum',
-                                       all_data=all_data, read=True)
+        tschannels = sorted(
+            set(self.get_channels('timeseries', 'spectrogram',
+                                  all_data=all_data, read=True) +
+                spchannels), key=lambda ch: ch.name)
         if len(tschannels):
             vprint("    %d channels identified for TimeSeries\n"
                    % len(tschannels))
@@ -477,8 +498,10 @@ class DataTab(DataTabBase):
             except (NameError, SyntaxError):
                 pass
 
-        for channel in self.get_channels('spectrogram', 'spectrum',
-                                         all_data=all_data, read=True):
+        for channel in sorted(
+                set(self.get_channels('spectrogram', all_data=all_data,
+                                      read=True) + spchannels),
+                key=lambda ch: ch.name):
             get_spectrogram(channel, state, config=config, return_=False,
                             multiprocess=multiprocess, **fftparams)
 
@@ -500,7 +523,8 @@ class DataTab(DataTabBase):
 
         for channel in self.get_channels(
                 'rayleigh-spectrum', all_data=all_data, read=True):
-            get_spectrum(channel, state, config=config, return_=False, **fp2)
+            get_spectrum(channel, state, config=config, return_=False,
+                         format='rayleigh', **fp2)
 
         # --------------------------------------------------------------------
         # process segments
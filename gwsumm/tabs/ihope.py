@@ -152,18 +152,18 @@ class DailyAhopeTab(base):
             if rangedata:
                 dt = float(abs(segcache[0].segment))
                 epoch = segcache[0].segment[0] + dt/2.
-                globalv.DATA[rangechannel].append(
-                    TimeSeries(rangedata, sample_rate=1/dt, epoch=epoch,
-                               name=rangechannel))
+                globalv.DATA.append(rangechannel, TimeSeries(
+                    rangedata, sample_rate=1/dt, epoch=epoch,
+                    name=rangechannel), coalesce=False)
                 try:
-                    globalv.DATA[rangechannel].coalesce()
+                    globalv.DATA.coalesce(rangechannel)
                 except ValueError:
                     pass
-                globalv.DATA[sizechannel].append(
-                    TimeSeries(sizedata, sample_rate=1/dt, epoch=epoch,
-                               name=sizechannel))
+                globalv.DATA.append(sizechannel, TimeSeries(
+                    sizedata, sample_rate=1/dt, epoch=epoch,
+                    name=sizechannel), coalesce=False)
                 try:
-                    globalv.DATA[sizechannel].coalesce()
+                    globalv.DATA.coalesce(sizechannel)
                 except ValueError:
                     pass
 
@@ -47,6 +47,7 @@ from .registry import (get_tab, register_tab)
 from .. import (globalv, version, html)
 from ..config import (NoOptionError, GWSummConfigParser)
 from ..data import (get_timeseries_dict, get_channel)
+from ..frames import datafind_connection
 from ..plot.registry import (get_plot, register_plot)
 from ..utils import (vprint, re_quote)
 
@@ -501,10 +502,10 @@ class SeiWatchDogPlot(get_plot('data')):
         if self.use_nds:
             data = TimeSeriesDict.fetch(self.chanlist, start, end)
         else:
-            from glue.datafind import GWDataFindHTTPConnection
-            conn = GWDataFindHTTPConnection()
-            cache = conn.find_frame_urls(self.ifo[0], '%s_C' % self.ifo,
-                                         self.start, self.end, urltype='file')
+            with datafind_connection() as conn:
+                cache = conn.find_frame_urls(self.ifo[0], '%s_C' % self.ifo,
+                                             self.start, self.end,
+                                             urltype='file')
             data = TimeSeriesDict.read(cache, self.chanlist, start=start,
                                        end=end, nproc=self.nproc)
 
@@ -34,6 +34,7 @@ from gwpy.segments import (DataQualityFlag, SegmentList)
 from . import globalv
 from .utils import (re_cchar, vprint)
 from .data import find_cache_segments
+from .frames import check_files_exist
 
 
 def get_triggers(channel, etg, segments, config=ConfigParser(), cache=None,
@@ -102,7 +103,7 @@ def get_triggers(channel, etg, segments, config=ConfigParser(), cache=None,
                     segcache = cache.sieve(segment=segment)
                     form = etg.lower()
                 # read triggers and store
-                segcache = segcache.checkfilesexist()[0]
+                segcache = check_files_exist(segcache)[0]
                 table = TableClass.read(segcache, columns=columns,
                                         format=form, filt=filter_)
             globalv.TRIGGERS[key].extend(table)
@@ -113,6 +114,7 @@ def get_triggers(channel, etg, segments, config=ConfigParser(), cache=None,
                 globalv.TRIGGERS[key].segments = csegs
             finally:
                 globalv.TRIGGERS[key].segments.coalesce()
+            globalv.TRIGGERS.enforce_budget(key)
             vprint('\r')
 
     # work out time function
@@ -82,6 +82,20 @@ def mkdir(*paths):
             os.makedirs(path)
 
 
+def get_cache_dir():
+    """Return the default directory for persistent GWSumm caches
+
+    This is ``$GWSUMM_CACHE_DIR`` if set, otherwise the ``gwsumm``
+    directory under ``$XDG_CACHE_HOME``, or ``~/.cache``.
+    """
+    try:
+        return os.environ['GWSUMM_CACHE_DIR']
+    except KeyError:
+        base = os.environ.get('XDG_CACHE_HOME',
+                              os.path.join(os.path.expanduser('~'), '.cache'))
+        return os.path.join(base, 'gwsumm')
+
+
 def nat_sorted(l, key=None):
     """Sorted a list in the way that humans expect.
 